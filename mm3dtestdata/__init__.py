@@ -4,9 +4,40 @@ __author__ = """Petrus H. Zwart"""
 __email__ = 'PHZwart@lbl.gov'
 __version__ = '0.1.0'
 
+import importlib
+
+# `noise` is imported eagerly: the function shadows the submodule of the same name.
 from .noise import noise
-from .cutter import schaaf
-from .builder import balls_and_eggs
-from .modalities import compute_weighted_map, build_material_maps_XCT_SEM_EDX
-from .blur import blur_it
-from .materials import build_composite_material_actions_XCT_SEM_EDX
+
+# The other public names are resolved on first access, so that `import mm3dtestdata`
+# does not pull in scipy and friends.
+_lazy_attributes = {
+    "schaaf": "cutter",
+    "balls_and_eggs": "builder",
+    "compute_weighted_map": "modalities",
+    "build_material_maps_XCT_SEM_EDX": "modalities",
+    "blur_and_project": "modalities",
+    "blur_it": "blur",
+    "build_composite_material_actions_XCT_SEM_EDX": "materials",
+}
+
+# Submodules are imported on first access as well; `noise` is not listed as the function shadows it.
+_lazy_submodules = ["blur", "builder", "cache", "chunked", "cutter", "ensemble", "fillers", "materials",
+                    "modalities", "precision", "rasterizer", "save_file", "seeding"]
+
+__all__ = ["noise"] + list(_lazy_attributes)
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        module = importlib.import_module("." + _lazy_attributes[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    if name in _lazy_submodules:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes) | set(_lazy_submodules))
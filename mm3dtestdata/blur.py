@@ -1,6 +1,15 @@
+import functools
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import scipy.fft
 from scipy.ndimage import gaussian_filter
 
+from mm3dtestdata import precision
+
 
 def one_hot_encode(class_map, num_classes):
     """
@@ -13,51 +22,464 @@ def one_hot_encode(class_map, num_classes):
     Returns:
     numpy.ndarray: A one-hot encoded array of shape (C, N, N, N).
     """
-    one_hot_map = np.eye(num_classes)[class_map]
+    one_hot_map = np.eye(num_classes, dtype=precision.float_dtype())[class_map]
     return np.moveaxis(one_hot_map, -1, 0)
 
-def apply_gaussian_blur(one_hot_map, sigma):
+def apply_gaussian_blur(one_hot_map, sigma, chunks=None, workers=None, backend="auto", cost_model=None):
     """
     Apply Gaussian blur to a one-hot encoded array.
 
     Args:
     one_hot_map (numpy.ndarray): A one-hot encoded array of shape (C, N, N, N).
     sigma (float or sequence of float): Standard deviation for Gaussian kernel.
+    chunks (int or tuple of int, optional): If given, every class volume is blurred block by block
+        in a thread pool, see chunked_gaussian_filter.
+    workers (int, optional): Number of threads for the chunked blur or the FFTs.
+    backend (str, optional): "spatial" for gaussian_filter, "fft" for fft_gaussian_filter with the
+        classes batched into as few transforms as the memory limit allows, or "auto" to let
+        choose_backend decide (spatial if chunks are given).
+    cost_model (blur_cost_model, optional): The costs and memory limit for "auto" and the batches.
 
     Returns:
     numpy.ndarray: A blurred array of the same shape as `one_hot_map`.
     """
+    sigma = tuple(np.broadcast_to(np.asarray(sigma, dtype=float), (one_hot_map.ndim - 1,)))
+    shape = one_hot_map.shape[1:]
+    real = np.result_type(one_hot_map.dtype, np.float32)
+    if _resolve_backend(backend, shape, sigma, chunks, real, cost_model) == "fft":
+        dtype = one_hot_map.dtype if one_hot_map.dtype.kind == "f" else real
+        blurred_map = np.empty(one_hot_map.shape, dtype=dtype)
+        batch = _fft_batch(shape, sigma, real, cost_model)
+        for start in range(0, one_hot_map.shape[0], batch):
+            fft_gaussian_filter(one_hot_map[start:start + batch], sigma, workers,
+                                out=blurred_map[start:start + batch])
+        return blurred_map
     blurred_map = np.zeros_like(one_hot_map)
     for i in range(one_hot_map.shape[0]):
-        blurred_map[i] = gaussian_filter(one_hot_map[i], sigma=sigma)
+        if chunks is None:
+            blurred_map[i] = gaussian_filter(one_hot_map[i], sigma=sigma)
+        else:
+            chunked_gaussian_filter(one_hot_map[i], sigma, chunks, workers, out=blurred_map[i])
     return blurred_map
 
-def renormalize(tensor):
+def _halo(sigma, ndim, truncate):
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (ndim,))
+    return tuple(int(truncate * s + 0.5) for s in sigma)
+
+def _block_regions(shape, chunks):
+    starts = [range(0, n, c) for n, c in zip(shape, chunks)]
+    for start in itertools.product(*starts):
+        yield tuple(slice(s, min(s + c, n)) for s, c, n in zip(start, chunks, shape))
+
+def _filter_block(image, out, region, halo, sigma, mode, truncate):
+    """
+    Filter one block of a volume, reading it with a halo, and write its core to `out`.
+    """
+    read = tuple(slice(max(r.start - h, 0), min(r.stop + h, n)) for r, h, n in zip(region, halo, image.shape))
+    block = gaussian_filter(np.asarray(image[read]), sigma=sigma, mode=mode, truncate=truncate)
+    out[region] = block[tuple(slice(r.start - q.start, r.stop - q.start) for r, q in zip(region, read))]
+
+def chunked_gaussian_filter(image, sigma, chunks=64, workers=None, out=None, mode="reflect", truncate=4.0):
+    """
+    Apply scipy.ndimage.gaussian_filter block by block.
+
+    Every block is read with a halo of truncate * sigma voxels, the reach of the kernel, and filtered
+    on its own; inside the volume the halo holds the real neighbours and at the volume border the
+    boundary mode applies exactly as for the whole volume, so the stitched result is identical to
+    gaussian_filter(image, sigma). Blocks are filtered in a thread pool.
+
+    Args:
+    image (array-like): A numpy or zarr array, or a dask array.
+    sigma (float or sequence of float): Standard deviation for Gaussian kernel.
+    chunks (int or tuple of int, optional): The block shape. Defaults to the chunks of a zarr `out`,
+        and is rounded up to multiples of them (of its shards, if sharded) otherwise.
+    workers (int, optional): Number of threads; defaults to the number of CPUs.
+    out (array-like, optional): A numpy or zarr array to write to; a new numpy array by default.
+    mode (str, optional): The boundary mode, as in gaussian_filter.
+    truncate (float, optional): Kernel radius in standard deviations, as in gaussian_filter.
+
+    Returns:
+    The filtered array: `out`, or a lazy dask array for dask input without `out`.
+    """
+    halo = _halo(sigma, image.ndim, truncate)
+    if hasattr(image, "map_overlap"):
+        lazy = image.map_overlap(gaussian_filter, depth=halo, boundary="none", dtype=image.dtype,
+                                 sigma=sigma, mode=mode, truncate=truncate)
+        if out is None:
+            return lazy
+        import dask.array as da
+        # the default lock serializes the writes, so blocks that share a zarr chunk do not clash
+        da.store(lazy, out)
+        return out
+
+    # the blocks must not share the chunks (or shards) of a zarr `out`, or concurrent writes get lost
+    grid = getattr(out, "shards", None) or getattr(out, "chunks", None)
+    if chunks is None:
+        chunks = grid or 64
+    if np.isscalar(chunks):
+        chunks = (int(chunks),) * image.ndim
+    if grid:
+        chunks = tuple(-(-int(c) // g) * g for c, g in zip(chunks, grid))
+    if out is None:
+        out = np.empty(image.shape, dtype=image.dtype)
+    regions = list(_block_regions(image.shape, chunks))
+    workers = os.cpu_count() if workers is None else workers
+    if workers <= 1 or len(regions) == 1:
+        for region in regions:
+            _filter_block(image, out, region, halo, sigma, mode, truncate)
+        return out
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(lambda region: _filter_block(image, out, region, halo, sigma, mode, truncate),
+                          regions):
+            pass
+    return out
+
+_PAD_MODES = {"reflect": "symmetric", "mirror": "reflect", "nearest": "edge", "constant": "constant"}
+
+@functools.lru_cache(maxsize=8)
+def _transfer_function(shape, sigma, dtype, truncate):
+    transfer = np.ones((), dtype=np.float64)
+    for axis, (length, s) in enumerate(zip(shape, sigma)):
+        frequencies = np.arange(length // 2 + 1 if axis == len(shape) - 1 else length)
+        if s > 0:
+            # the DFT of the (symmetric) kernel of gaussian_filter, wrapped onto the padded length
+            radius = int(truncate * s + 0.5)
+            x = np.arange(-radius, radius + 1)
+            kernel = np.exp(-0.5 / s ** 2 * x ** 2)
+            kernel /= kernel.sum()
+            factor = kernel @ np.cos(2 * np.pi / length * np.outer(x, frequencies))
+        else:
+            factor = np.ones(len(frequencies))
+        transfer = np.multiply.outer(transfer, factor)
+    transfer = transfer.astype(dtype)
+    transfer.setflags(write=False)
+    return transfer
+
+def gaussian_transfer_function(shape, sigma, dtype=np.float64, truncate=4.0):
+    """
+    The real FFT of the kernel of gaussian_filter on a periodic grid; cached.
+
+    Args:
+    shape (tuple of int): The shape of the transformed axes.
+    sigma (float or sequence of float): Standard deviation for Gaussian kernel.
+    dtype (numpy.dtype, optional): The real data type of the result.
+    truncate (float, optional): Kernel radius in standard deviations, as in gaussian_filter.
+
+    Returns:
+    numpy.ndarray: A read-only array of the shape of scipy.fft.rfftn over `shape`. The transfer
+    functions of the 8 most recent (shape, sigma, dtype, truncate) combinations are kept.
+    """
+    sigma = tuple(float(s) for s in np.broadcast_to(np.asarray(sigma, dtype=float), (len(shape),)))
+    return _transfer_function(tuple(int(n) for n in shape), sigma, np.dtype(dtype).str, float(truncate))
+
+def fft_gaussian_filter(image, sigma, workers=None, mode="reflect", truncate=4.0, out=None):
+    """
+    Apply the filter of scipy.ndimage.gaussian_filter with real FFTs.
+
+    The image is padded by at least the kernel radius according to the boundary mode (up to a
+    length with small prime factors), transformed with
+    scipy.fft.rfftn, multiplied by the cached transfer function and transformed back. The cost does
+    not grow with sigma, and the result equals gaussian_filter up to rounding.
+
+    Args:
+    image (numpy.ndarray): The image. Leading axes beyond those of `sigma` are filtered as a batch in
+        the same transform, e.g. all classes of a (C, N, N, N) one-hot map.
+    sigma (float or sequence of float): Standard deviation for Gaussian kernel. A float applies to
+        the last three axes (or all axes of a smaller image), a sequence to the last len(sigma) axes.
+    workers (int, optional): Number of threads of scipy.fft; all CPUs by default.
+    mode (str, optional): "reflect", "mirror", "nearest", "constant" (with zeros) or "wrap".
+    truncate (float, optional): Kernel radius in standard deviations, as in gaussian_filter.
+    out (numpy.ndarray, optional): Array to write the result to.
+
+    Returns:
+    numpy.ndarray: The filtered image.
+    """
+    image = np.asarray(image)
+    ndim = len(sigma) if np.ndim(sigma) else min(3, image.ndim)
+    sigma = tuple(float(s) for s in np.broadcast_to(np.asarray(sigma, dtype=float), (ndim,)))
+    lead = image.ndim - ndim
+    real = np.result_type(image.dtype, np.float32)
+    halo = (0,) * ndim if mode == "wrap" else _halo(sigma, ndim, truncate)
+    if mode != "wrap" and mode not in _PAD_MODES:
+        raise ValueError("unknown boundary mode %r" % mode)
+    padded = image.astype(real, copy=False)
+    if any(halo):
+        # past the halo the padding only has to reach a length the FFT handles fast
+        pad = [(h, scipy.fft.next_fast_len(n + 2 * h, real=True) - n - h) if h else (0, 0)
+               for n, h in zip(image.shape[lead:], halo)]
+        padded = np.pad(padded, [(0, 0)] * lead + pad, mode=_PAD_MODES[mode])
+
+    axes = tuple(range(lead, image.ndim))
+    workers = -1 if workers is None else workers
+    spectrum = scipy.fft.rfftn(padded, axes=axes, workers=workers)
+    spectrum *= gaussian_transfer_function(padded.shape[lead:], sigma, real, truncate)
+    result = scipy.fft.irfftn(spectrum, s=padded.shape[lead:], axes=axes, workers=workers)
+    result = result[(Ellipsis,) + tuple(slice(h, h + n) for h, n in zip(halo, image.shape[lead:]))]
+    if out is None:
+        return np.ascontiguousarray(result, dtype=image.dtype if image.dtype.kind == "f" else real)
+    out[...] = result
+    return out
+
+# Cost model of the two backends in seconds, fitted by calibrate_backend: the spatial filter takes
+# SPATIAL_COST[0] per voxel plus SPATIAL_COST[1] per voxel and kernel tap, the FFT backend takes
+# FFT_COST per M log2 M for the padded size M. Fitted to 64**3 to 192**3 float64 volumes with
+# sigma 1 to 32 on one core: the FFT then wins narrowly from about 256**3 and sigma 4 on, while its
+# padding of 4 sigma per side keeps very large sigma on small volumes spatial. Recalibrate on
+# machines with many cores, since the FFTs run multithreaded.
+SPATIAL_COST = (3.3e-08, 4.5e-10)
+FFT_COST = 2.2e-09
+# Working memory in bytes the FFT backend may take for one batch of classes; a volume whose single
+# class does not fit is blurred spatially.
+FFT_MEMORY_LIMIT = 2 ** 30
+
+def _spatial_cost(shape, sigma, truncate):
+    taps = sum(2 * int(truncate * s + 0.5) + 1 for s in sigma if s > 0)
+    return float(np.prod(shape)) * np.array([1.0, taps])
+
+def _padded_size(shape, sigma, truncate):
+    return float(np.prod([scipy.fft.next_fast_len(n + 2 * h, real=True) if h else n
+                          for n, h in zip(shape, _halo(sigma, len(shape), truncate))]))
+
+def _fft_cost(shape, sigma, truncate):
+    size = _padded_size(shape, sigma, truncate)
+    return size * np.log2(size)
+
+class blur_cost_model(object):
+    """
+    Predicted run time and memory of the two blur backends, used by choose_backend.
+
+    Parameters:
+    - spatial_cost (tuple of float, optional): Seconds per voxel, and per voxel and kernel tap, of
+      gaussian_filter; SPATIAL_COST by default.
+    - fft_cost (float, optional): Seconds per M log2 M of fft_gaussian_filter, M the padded size;
+      FFT_COST by default.
+    - memory_limit (int, optional): Bytes of working memory the FFT backend may use at once;
+      FFT_MEMORY_LIMIT by default. Classes are transformed in batches that fit.
+    - timings (list, optional): The timings the costs were fitted to, see calibrate_backend.
+    """
+    def __init__(self, spatial_cost=None, fft_cost=None, memory_limit=None, timings=None):
+        self.spatial_cost = SPATIAL_COST if spatial_cost is None else tuple(spatial_cost)
+        self.fft_cost = FFT_COST if fft_cost is None else fft_cost
+        self.memory_limit = FFT_MEMORY_LIMIT if memory_limit is None else memory_limit
+        self.timings = timings
+
+    def fft_bytes(self, shape, sigma, itemsize=8, truncate=4.0):
+        """
+        The working memory of fft_gaussian_filter per class: the input and output volumes plus the
+        padded volume, its spectrum, its inverse transform and the cached transfer function.
+        """
+        return itemsize * (2 * float(np.prod(shape)) + 3.5 * _padded_size(shape, sigma, truncate))
+
+    def batch_size(self, shape, sigma, itemsize=8, truncate=4.0):
+        """
+        The number of classes that fit in one FFT within memory_limit; 0 if not even one does.
+        """
+        return int(self.memory_limit // self.fft_bytes(shape, sigma, itemsize, truncate))
+
+    def choose(self, shape, sigma, itemsize=8, truncate=4.0):
+        """
+        "fft" if the FFT is predicted to be faster and one class fits in memory_limit, else "spatial".
+        """
+        if self.batch_size(shape, sigma, itemsize, truncate) < 1:
+            return "spatial"
+        spatial = np.dot(self.spatial_cost, _spatial_cost(shape, sigma, truncate))
+        if self.fft_cost * _fft_cost(shape, sigma, truncate) < spatial:
+            return "fft"
+        return "spatial"
+
+def choose_backend(shape, sigma, truncate=4.0, dtype=np.float64, model=None):
+    """
+    Pick the blur for a volume: "spatial" (separable gaussian_filter) or "fft".
+
+    The spatial filter grows linearly with the kernel size and so with sigma; the FFT costs about
+    M log M for the padded size M, but needs several padded volumes of working memory. The FFT is
+    picked when it is predicted to be faster and a single class fits in the memory limit of the
+    model; see blur_cost_model and calibrate_backend.
+
+    Args:
+    shape (tuple of int): The shape of the blurred axes.
+    sigma (float or sequence of float): Standard deviation for Gaussian kernel.
+    truncate (float, optional): Kernel radius in standard deviations.
+    dtype (numpy.dtype, optional): The floating point type of the volumes.
+    model (blur_cost_model, optional): The cost model; the default costs and memory limit if None.
+
+    Returns:
+    str: "spatial" or "fft".
+    """
+    sigma = tuple(np.broadcast_to(np.asarray(sigma, dtype=float), (len(shape),)))
+    model = blur_cost_model() if model is None else model
+    return model.choose(shape, sigma, np.dtype(dtype).itemsize, truncate)
+
+def _resolve_backend(backend, shape, sigma, chunks, dtype, model):
+    if backend == "auto":
+        return "spatial" if chunks is not None else choose_backend(shape, sigma, dtype=dtype, model=model)
+    if backend not in ("spatial", "fft"):
+        raise ValueError("unknown blur backend %r" % backend)
+    return backend
+
+def _fft_batch(shape, sigma, dtype, model):
+    model = blur_cost_model() if model is None else model
+    return max(1, model.batch_size(shape, sigma, np.dtype(dtype).itemsize))
+
+def calibrate_backend(sizes=(64, 128), sigmas=(1.0, 2.0, 4.0, 8.0, 16.0), workers=None, repeat=2,
+                      memory_limit=None):
+    """
+    Time both backends on this machine and fit a cost model to the timings.
+
+    Args:
+    sizes (sequence of int): Edge lengths of the test volumes.
+    sigmas (sequence of float): The sigmas to time.
+    workers (int, optional): Number of FFT threads, as for fft_gaussian_filter.
+    repeat (int): Timings per case; the fastest counts.
+    memory_limit (int, optional): The memory limit of the model, see blur_cost_model.
+
+    Returns:
+    blur_cost_model: The fitted model, to pass to choose_backend, blur_it or apply_gaussian_blur.
+    Its `timings` hold (size, sigma, seconds spatial, seconds fft) for every case. The module
+    defaults SPATIAL_COST and FFT_COST are left alone.
+    """
+    timings, spatial_costs, fft_costs = [], [], []
+    for size in sizes:
+        image = np.random.default_rng(0).random((size,) * 3)
+        for sigma in sigmas:
+            spatial = min(_time(gaussian_filter, image, sigma) for _ in range(repeat))
+            fft = min(_time(fft_gaussian_filter, image, sigma, workers) for _ in range(repeat))
+            timings.append((size, sigma, spatial, fft))
+            spatial_costs.append(_spatial_cost(image.shape, (sigma,) * 3, 4.0))
+            fft_costs.append(_fft_cost(image.shape, (sigma,) * 3, 4.0))
+    spatial_times = np.array([t[2] for t in timings])
+    fft_times = np.array([t[3] for t in timings])
+    spatial_cost = np.linalg.lstsq(np.array(spatial_costs), spatial_times, rcond=None)[0]
+    fft_cost = float(np.dot(fft_costs, fft_times) / np.dot(fft_costs, fft_costs))
+    return blur_cost_model([float(c) for c in spatial_cost], fft_cost, memory_limit, timings)
+
+def _time(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def renormalize(tensor, out=None):
     """
     Renormalize a tensor so that it sums to 1 across the first axis.
 
     Args:
     tensor (numpy.ndarray): A multidimensional array.
+    out (numpy.ndarray, optional): Array to write the result to; pass `tensor` to renormalize in place.
 
     Returns:
     numpy.ndarray: A renormalized array.
     """
     sum_over_classes = tensor.sum(axis=0, keepdims=True)
     sum_over_classes[sum_over_classes == 0] = 1  # Avoid division by zero
-    return tensor / sum_over_classes
+    return np.divide(tensor, sum_over_classes, out=out)
 
-def blur_it(class_map, sigma):
+def blur_it(class_map, sigma, dtype=None, chunks=None, workers=None, backend="auto", cost_model=None):
     """
     Apply a Gaussian blur to a class map and renormalize the results.
 
+    The class indicators are built and blurred one class at a time, straight into
+    a single preallocated output, and classes that do not occur are skipped, so no
+    dense one-hot tensor is ever formed.
+
     Args:
     class_map (numpy.ndarray): A 3D array of shape (N, N, N) containing class labels.
     sigma (float or sequence of float): Standard deviation for Gaussian kernel.
+    dtype (numpy.dtype, optional): Data type of the result, e.g. np.float32 to halve memory use;
+        that of the precision policy by default.
+    chunks (int or tuple of int, optional): If given, every class is blurred block by block in a
+        thread pool, see chunked_gaussian_filter; the result is the same.
+    workers (int, optional): Number of threads for the chunked blur or the FFTs.
+    backend (str, optional): "spatial", "fft" or "auto" (see choose_backend). The FFT backend
+        blurs the present classes in batched transforms, as many classes per batch as fit in the
+        memory limit of the cost model.
+    cost_model (blur_cost_model, optional): The costs and memory limit for "auto" and the batches.
 
     Returns:
-    numpy.ndarray: A blurred and renormalized array of shape (C, N, N, N).
+    numpy.ndarray: A blurred and renormalized array of shape (C, N, N, N). If the precision policy
+    sets a probability_dtype, the probabilities are returned quantized to it (see precision.quantize).
+    """
+    dtype = precision.float_dtype(dtype)
+    num_classes = int(np.max(class_map)) + 1
+    present = np.bincount(class_map.ravel(), minlength=num_classes) > 0
+    result = np.zeros((num_classes,) + class_map.shape, dtype=dtype)
+    axes_sigma = tuple(np.broadcast_to(np.asarray(sigma, dtype=float), (class_map.ndim,)))
+    if _resolve_backend(backend, class_map.shape, axes_sigma, chunks, dtype, cost_model) == "fft":
+        labels = np.flatnonzero(present)
+        batch = _fft_batch(class_map.shape, axes_sigma, dtype, cost_model)
+        for start in range(0, len(labels), batch):
+            group = labels[start:start + batch]
+            indicators = np.empty((len(group),) + class_map.shape, dtype=dtype)
+            for indicator, label in zip(indicators, group):
+                np.equal(class_map, label, out=indicator, casting='unsafe')
+            result[group] = fft_gaussian_filter(indicators, axes_sigma, workers)
+            del indicators
+        return _finish_probabilities(result)
+
+    indicator = np.empty(class_map.shape, dtype=dtype)
+    for label in np.flatnonzero(present):
+        np.equal(class_map, label, out=indicator, casting='unsafe')
+        if chunks is None:
+            gaussian_filter(indicator, sigma=sigma, output=result[label])
+        else:
+            chunked_gaussian_filter(indicator, sigma, chunks, workers, out=result[label])
+    return _finish_probabilities(result)
+
+def _finish_probabilities(result):
+    """
+    Renormalize blurred class indicators in place and quantize them if the precision policy says so.
     """
-    result = one_hot_encode(class_map, int(np.max(class_map)) + 1)
-    result = apply_gaussian_blur(result, sigma)
-    result = renormalize(result)
+    result = renormalize(result, out=result)
+    quantized = precision.get_policy().probability_dtype
+    if quantized is not None:
+        return precision.quantize(result, quantized)
     return result
+
+def blur_scale_space(class_map, sigmas, dtype=None, chunks=None, workers=None):
+    """
+    Blur a class map at several sigmas, reusing every level to reach the next one.
+
+    Gaussians compose: blurring with sigma_1 and then with sqrt(sigma_2**2 - sigma_1**2) gives a
+    blur with sigma_2. The class indicators are built once and blurred in increasing order of
+    sigma, each step with the small incremental kernel only. The levels match blur_it up to the
+    sampling of the kernels, which makes little difference once sigma is about one voxel or more.
+
+    Args:
+    class_map (numpy.ndarray): A 3D array of shape (N, N, N) containing class labels.
+    sigmas (list): Standard deviations, each a float or a sequence of one float per axis. Per-axis
+        sigmas must grow along every axis in order of their size.
+    dtype (numpy.dtype, optional): Data type of the results; that of the precision policy by default.
+    chunks (int or tuple of int, optional): Blur block by block, see chunked_gaussian_filter.
+    workers (int, optional): Number of threads for the chunked blur.
+
+    Returns:
+    list of numpy.ndarray: For every sigma, in the given order, the blurred and renormalized array of
+    shape (C, N, N, N), as returned by blur_it (quantized if the precision policy says so).
+    """
+    dtype = precision.float_dtype(dtype)
+    num_classes = int(np.max(class_map)) + 1
+    present = np.flatnonzero(np.bincount(class_map.ravel(), minlength=num_classes))
+    current = np.zeros((num_classes,) + class_map.shape, dtype=dtype)
+    for label in present:
+        np.equal(class_map, label, out=current[label], casting='unsafe')
+
+    sigmas = [np.broadcast_to(np.asarray(sigma, dtype=float), (class_map.ndim,)) for sigma in sigmas]
+    quantized = precision.get_policy().probability_dtype
+    buffer = np.empty(class_map.shape, dtype=dtype)
+    previous = np.zeros(class_map.ndim)
+    levels = [None] * len(sigmas)
+    for index in sorted(range(len(sigmas)), key=lambda i: np.sum(sigmas[i] ** 2)):
+        step = sigmas[index] ** 2 - previous ** 2
+        if np.any(step < 0):
+            raise ValueError("per-axis sigmas %s and %s cannot be ordered" % (previous, sigmas[index]))
+        step = np.sqrt(step)
+        if np.any(step > 0):
+            for label in present:
+                if chunks is None:
+                    gaussian_filter(current[label], sigma=step, output=buffer)
+                else:
+                    chunked_gaussian_filter(current[label], step, chunks, workers, out=buffer)
+                current[label] = buffer
+        previous = sigmas[index]
+        level = renormalize(current, out=np.empty_like(current))
+        levels[index] = level if quantized is None else precision.quantize(level, quantized)
+    return levels
@@ -1,8 +1,26 @@
 from scipy.stats.qmc import PoissonDisk
 import numpy as np
-from scipy.spatial.distance import cdist
 
 from mm3dtestdata import fillers
+from mm3dtestdata import precision
+from mm3dtestdata import rasterizer
+from mm3dtestdata import seeding
+
+
+def label_dtype(max_label):
+    """
+    Picks the smallest unsigned integer type that can hold a label.
+
+    Parameters:
+    - max_label (int): The largest label that has to be stored.
+
+    Returns:
+    - numpy.dtype: One of uint8, uint16, uint32 or uint64.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError("label %s does not fit in an unsigned 64 bit integer" % max_label)
 
 
 class balls_and_eggs(object):
@@ -19,7 +37,8 @@ class balls_and_eggs(object):
                  matrix_density=0.5,
                  sphere_density=1.0,
                  ellipsoid_density=1.0,
-                 seed=None
+                 seed=None,
+                 rng=None
                  ):
         """
         Initializes the balls_and_eggs object, generating a set of coordinates within a specified space.
@@ -37,6 +56,10 @@ class balls_and_eggs(object):
         - sphere_density (float): Density of spheres.
         - ellipsoid_density (float): Density of ellipsoids.
         - seed (int, optional): Seed for random number generation. None for random seed.
+        - rng (int, SeedSequence or Generator, optional): If given, `seed` and the global np.random state are
+          not used. Instead the Poisson disk sampling, every object (shape, scale, rotation) and the
+          perturbations each draw from their own stream spawned from `rng`, so scenes are reproducible
+          in any process.
         """
         self.scale = scale
         self.radius = radius
@@ -54,6 +77,14 @@ class balls_and_eggs(object):
         self.sphere_density = sphere_density
         self.ellipsoid_density = ellipsoid_density
 
+        object_seeds = None
+        # None means the legacy global np.random state; a module cannot be pickled
+        self._random_state = None
+        if rng is not None:
+            poisson_seed, object_seeds, perturb_seed = seeding.seed_sequence(rng).spawn(3)
+            seed = np.random.default_rng(poisson_seed)
+            self._random_state = np.random.default_rng(perturb_seed)
+
         # first generate a set of coordinates
         poisson_obj = PoissonDisk(d=3, radius=radius / scale, hypersphere='volume', ncandidates=30, optimization=None,
                                   seed=seed)
@@ -69,68 +100,188 @@ class balls_and_eggs(object):
         self.instance_marker = []
         self.multi = []
 
+        if object_seeds is None:
+            object_rngs = [np.random] * self.xyz.shape[0]
+        else:
+            object_rngs = seeding.spawn(object_seeds, self.xyz.shape[0])
+
         count = 2
-        for _ in self.xyz:
+        for object_rng in object_rngs:
             rotation_matrix = None
-            shape = 'sphere' if np.random.rand() > fraction else 'ellipsoid'
+            shape = 'sphere' if object_rng.random() > fraction else 'ellipsoid'
             if shape == 'ellipsoid':
-                rotation_matrix = fillers.random_rotation_matrix()
+                rotation_matrix = fillers.random_rotation_matrix(rng=object_rng)
             self.rotation_matrix.append(rotation_matrix)
             self.item_type.append(shape)
-            this_multi = np.random.rand()
+            this_multi = object_rng.random()
             this_multi = this_multi * delta - delta / 2.0 + mean_scale
             self.multi.append(this_multi)
             self.instance_marker.append(count)
             count += 1
         self.eraser = np.ones(self.xyz.shape[0])
+        self._fill_state = None
+
+    def object_table(self, include_erased=False):
+        """
+        Collects the objects that are currently not erased into a table.
+
+        Parameters:
+        - include_erased (bool): If True, erased objects are kept in the table as well.
+
+        Returns:
+        - dict: An object table (see rasterizer.build_object_table), in drawing order.
+        """
+        active = self.eraser > 0
+        if include_erased:
+            active = np.ones_like(active)
+        multi = np.asarray(self.multi, dtype=float)
+        is_sphere = np.array([shape == 'sphere' for shape in self.item_type], dtype=bool)
+        kind = np.where(is_sphere, rasterizer.SPHERE, rasterizer.ELLIPSOID)
+        major_axis = np.where(is_sphere, self.sphere_radius * multi, self.major_axis * multi)
+        minor_axis = np.where(is_sphere, self.sphere_radius * multi, self.minor_axis * multi)
+        rotation_matrix = np.array([np.eye(3) if rot_mat is None else rot_mat
+                                    for rot_mat in self.rotation_matrix]).reshape(-1, 3, 3)
+        class_label = np.where(is_sphere, 2, 3)
+        density = np.where(is_sphere, self.sphere_density, self.ellipsoid_density)
+        instance_label = np.asarray(self.instance_marker, dtype=int)
 
-    def fill(self):
+        return rasterizer.build_object_table((self.xyz + self.delta)[active],
+                                             kind[active],
+                                             major_axis[active],
+                                             minor_axis[active],
+                                             rotation_matrix[active],
+                                             class_label[active],
+                                             instance_label[active],
+                                             density[active])
+
+    def fill(self, tile_size=16, incremental=False, dtype=None, class_dtype=None, instance_dtype=None, out=None):
         """
         Fills the defined space with spheres and ellipsoids according to the object's properties.
 
+        Parameters:
+        - tile_size (int): Edge length of the tiles used by the batch rasterizer.
+        - incremental (bool): If True, the filled volumes and the footprint of every object are kept.
+          A following incremental fill only clears and redraws the tiles touched by objects whose
+          delta or eraser changed since, which includes their overlapping neighbours.
+        - dtype: Data type of the volume, e.g. np.float32. Defaults to the float type of the
+          precision policy.
+        - class_dtype, instance_dtype: Data types of the label maps. 'auto' picks the smallest
+          unsigned integer type that holds the largest label (see label_dtype). Default to the
+          label type of the precision policy.
+        - out (tuple, optional): Arrays (volume, instance_map, class_map) of shape (scale, scale, scale)
+          that are overwritten and returned instead of allocating new ones. Their data types take
+          precedence over the dtype arguments. With incremental=True the kept volumes are still
+          allocated internally and copied into `out`, which costs one extra set of volumes.
+
         Returns:
         - volume (numpy.ndarray): A 3D array representing the filled volume.
         - instance_map (numpy.ndarray): A 3D array mapping each instance in the volume.
         - class_map (numpy.ndarray): A 3D array mapping the class of each item in the volume.
         """
         N = int(self.scale)
-        volume = np.zeros((N, N, N))
-        class_map = np.zeros_like(volume).astype(int)
-        instance_map = np.zeros_like(volume).astype(int)
-        for xyz, delta, multi, shape, rot_mat, inst_lab, erased in zip(self.xyz,
-                                                                       self.delta,
-                                                                       self.multi,
-                                                                       self.item_type,
-                                                                       self.rotation_matrix,
-                                                                       self.instance_marker,
-                                                                       self.eraser,
-                                                                       ):
-            if erased > 0:
-                if shape == 'sphere':
-                    fillers.fill_sphere(xyz + delta,
-                                        self.sphere_radius * multi,
-                                        volume,
-                                        class_map,
-                                        instance_map,
-                                        density=self.sphere_density,
-                                        class_label=2,
-                                        instance_label=int(inst_lab)
-                                        )
-
-                if shape == 'ellipsoid':
-                    fillers.fill_ellipsoid(xyz + delta,
-                                           self.major_axis * multi,
-                                           self.minor_axis * multi,
-                                           volume,
-                                           class_map,
-                                           instance_map,
-                                           rotation_matrix=rot_mat,
-                                           class_label=3,
-                                           density=self.ellipsoid_density,
-                                           instance_label=inst_lab
-                                           )
-
-        fillers.matrix([N / 2, N / 2, N / 2],
+        if out is not None:
+            assert all(array.shape == (N, N, N) for array in out)
+            dtypes = (out[0].dtype, out[2].dtype, out[1].dtype)
+        else:
+            dtypes = self._fill_dtypes(dtype, class_dtype, instance_dtype)
+        self._check_label_dtypes(dtypes[1], dtypes[2])
+
+        state = self._fill_state
+        if (not incremental or state is None or state["tile_size"] != tile_size
+                or state["dtypes"] != dtypes):
+            if out is not None and not incremental:
+                volume, instance_map, class_map = out
+                volume[...] = 0
+                class_map[...] = 0
+                instance_map[...] = 0
+            else:
+                volume = np.zeros((N, N, N), dtype=dtypes[0])
+                class_map = np.zeros((N, N, N), dtype=dtypes[1])
+                instance_map = np.zeros((N, N, N), dtype=dtypes[2])
+            tiles = None
+        else:
+            volume = state["volume"]
+            class_map = state["class_map"]
+            instance_map = state["instance_map"]
+            tiles = self._changed_tiles(state)
+            for _, tile in rasterizer.tile_slices(volume.shape, tile_size, tiles):
+                volume[tile] = 0
+                class_map[tile] = 0
+                instance_map[tile] = 0
+
+        table = self.object_table()
+        if tiles is None:
+            self.fill_block(volume, class_map, instance_map, table=table, tile_size=tile_size)
+        else:
+            for _, tile in rasterizer.tile_slices(volume.shape, tile_size, tiles):
+                origin = (tile[0].start, tile[1].start, tile[2].start)
+                self.fill_block(volume[tile], class_map[tile], instance_map[tile],
+                                origin=origin, table=table, tile_size=tile_size)
+
+        if incremental:
+            self._fill_state = {"tile_size": tile_size,
+                                "dtypes": dtypes,
+                                "volume": volume,
+                                "class_map": class_map,
+                                "instance_map": instance_map,
+                                "delta": self.delta.copy(),
+                                "eraser": self.eraser.copy(),
+                                "footprints": self._footprints()}
+            if out is not None:
+                np.copyto(out[0], volume)
+                np.copyto(out[1], instance_map)
+                np.copyto(out[2], class_map)
+                return out
+            return volume.copy(), instance_map.copy(), class_map.copy()
+
+        return volume, instance_map, class_map
+
+    def _fill_dtypes(self, dtype, class_dtype, instance_dtype):
+        """
+        Resolves the data types of the volume, class map and instance map.
+
+        Returns:
+        - tuple of numpy.dtype: The volume, class map and instance map data types.
+        """
+        dtype = precision.float_dtype(dtype)
+        class_dtype = precision.policy_label_dtype(class_dtype)
+        instance_dtype = precision.policy_label_dtype(instance_dtype)
+        if class_dtype == 'auto':
+            class_dtype = label_dtype(3)
+        if instance_dtype == 'auto':
+            instance_dtype = label_dtype(max(self.instance_marker, default=1))
+        return np.dtype(dtype), np.dtype(class_dtype), np.dtype(instance_dtype)
+
+    def _check_label_dtypes(self, class_dtype, instance_dtype):
+        """
+        Raises a ValueError if an integer label map type cannot hold the largest class or instance label.
+        """
+        for name, dtype, max_label in (("class", class_dtype, 3),
+                                       ("instance", instance_dtype, max(self.instance_marker, default=1))):
+            if dtype.kind in "iu" and max_label > np.iinfo(dtype).max:
+                raise ValueError("%s label %s does not fit in %s" % (name, max_label, dtype))
+
+    def fill_block(self, volume, class_map, instance_map, origin=(0, 0, 0), table=None, tile_size=16):
+        """
+        Draws the objects and the matrix into a block of the full volume.
+
+        Parameters:
+        - volume, class_map, instance_map (numpy.ndarray): Zero-initialized 3D arrays for the block.
+        - origin (tuple of int): Position of the block's first voxel in the full volume.
+        - table (dict, optional): Object table to draw; defaults to object_table().
+        - tile_size (int): Edge length of the tiles used by the batch rasterizer.
+        """
+        N = int(self.scale)
+        if table is None:
+            table = self.object_table()
+        rasterizer.fill_objects(table,
+                                volume,
+                                class_map,
+                                instance_map,
+                                tile_size=tile_size,
+                                origin=origin)
+
+        fillers.matrix([N / 2 - origin[0], N / 2 - origin[1], N / 2 - origin[2]],
                        N,
                        volume,
                        class_map,
@@ -138,7 +289,40 @@ class balls_and_eggs(object):
                        1,
                        )
 
-        return volume, instance_map, class_map
+    def _footprints(self):
+        """
+        Computes the clipped bounding box of every object, erased or not.
+
+        Returns:
+        - tuple of numpy.ndarray: Arrays lo and hi of shape (M, 3).
+        """
+        N = int(self.scale)
+        return rasterizer.object_bounds(self.object_table(include_erased=True), (N, N, N))
+
+    def _changed_tiles(self, state):
+        """
+        Finds the tiles that need to be redrawn since the last incremental fill.
+
+        Parameters:
+        - state (dict): The state stored by the last incremental fill.
+
+        Returns:
+        - numpy.ndarray: A boolean mask over the tile grid.
+        """
+        old_lo, old_hi = state["footprints"]
+        new_lo, new_hi = self._footprints()
+        was_drawn = state["eraser"] > 0
+        is_drawn = self.eraser > 0
+        changed = np.any(self.delta != state["delta"], axis=1) | (was_drawn != is_drawn)
+
+        old = changed & was_drawn
+        new = changed & is_drawn
+        lo = np.concatenate([old_lo[old], new_lo[new]])
+        hi = np.concatenate([old_hi[old], new_hi[new]])
+        return rasterizer.tile_mask(lo, hi, state["volume"].shape, state["tile_size"])
+
+    def _random(self):
+        return np.random if self._random_state is None else self._random_state
 
     def _shake(self, rmsd=2.0):
         """
@@ -150,7 +334,7 @@ class balls_and_eggs(object):
         Returns:
         - numpy.ndarray: An array of perturbations for each coordinate.
         """
-        d = np.random.normal(0, rmsd ** 2.0 / 3.0, self.delta.shape)
+        d = self._random().normal(0, rmsd ** 2.0 / 3.0, self.delta.shape)
         return d
 
     def _cut(self, z, dz):
@@ -182,7 +366,7 @@ class balls_and_eggs(object):
         N_items = self.xyz.shape[0]
         pick_M = max(1, int(N_items * fraction))
         s = np.arange(N_items)
-        these_indices = np.random.choice(s, pick_M, replace=False)
+        these_indices = self._random().choice(s, pick_M, replace=False)
         return these_indices
 
     def perturb(self, shake=None, cut=None, erase=None):
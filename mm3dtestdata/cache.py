@@ -0,0 +1,265 @@
+"""Content-addressed on-disk cache of generated scenes."""
+import functools
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+
+import mm3dtestdata
+from mm3dtestdata import precision
+from mm3dtestdata.blur import blur_it
+from mm3dtestdata.builder import balls_and_eggs
+from mm3dtestdata.modalities import build_material_maps_XCT_SEM_EDX
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.random.SeedSequence):
+        return {"entropy": value.entropy, "spawn_key": list(value.spawn_key)}
+    raise TypeError("cannot hash a parameter of type %s" % type(value).__name__)
+
+
+def parameter_key(stage, params):
+    """
+    Hash a stage name, its parameters, the package version and the precision policy.
+
+    Parameters:
+    - stage (str): The name of the stage.
+    - params (dict): All parameters the stage depends on; must be JSON serializable (numpy scalars,
+      arrays and SeedSequences are converted).
+
+    Returns:
+    - str: A hex digest that changes whenever any of these change.
+    """
+    text = json.dumps({"stage": stage, "params": params, "version": mm3dtestdata.__version__,
+                       "precision": repr(precision.get_policy())},
+                      sort_keys=True, default=_jsonable)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class scene_cache(object):
+    """
+    A directory of cached stage results, evicted least recently used first.
+
+    Every entry lives in <directory>/<stage>/<key> and holds one .npy file per array (or a zarr group)
+    plus a meta.json file with the parameters. On a hit the arrays are returned memory-mapped and
+    read-only, so nothing is copied into memory until it is used.
+
+    Parameters:
+    - directory (str): Where to keep the cache; created if needed.
+    - max_bytes (int, optional): The size the cache is trimmed to after every store. No limit if None.
+    - storage (str): "npy" for memory-mapped .npy files, "zarr" for zarr arrays.
+    """
+    def __init__(self, directory, max_bytes=None, storage="npy"):
+        if storage not in ("npy", "zarr"):
+            raise ValueError("unknown storage %r" % storage)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.storage = storage
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, stage, key):
+        return os.path.join(self.directory, stage, key)
+
+    def _load(self, path):
+        with open(os.path.join(path, "meta.json")) as handle:
+            names = json.load(handle)["arrays"]
+        if self.storage == "zarr":
+            import zarr
+            group = zarr.open_group(os.path.join(path, "arrays.zarr"), mode="r")
+            return {name: group[name] for name in names}
+        return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in names}
+
+    def _store(self, path, stage, params, arrays):
+        tmp = path + ".tmp-" + uuid.uuid4().hex
+        os.makedirs(tmp)
+        if self.storage == "zarr":
+            import zarr
+            group = zarr.open_group(os.path.join(tmp, "arrays.zarr"), mode="w")
+            for name, array in arrays.items():
+                group.create_array(name, data=np.asarray(array))
+        else:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + ".npy"), np.asarray(array))
+        with open(os.path.join(tmp, "meta.json"), "w") as handle:
+            json.dump({"stage": stage, "params": params, "version": mm3dtestdata.__version__,
+                       "arrays": list(arrays)}, handle, indent=1, default=_jsonable)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def get(self, stage, params, build):
+        """
+        Return the arrays of a stage, building and storing them on a miss.
+
+        Parameters:
+        - stage (str): The name of the stage.
+        - params (dict): Everything the result depends on, see parameter_key.
+        - build (callable): Called without arguments on a miss; returns a dict of arrays.
+
+        Returns:
+        - dict: The arrays, memory-mapped from the cache.
+        """
+        path = self._path(stage, parameter_key(stage, params))
+        if os.path.exists(os.path.join(path, "meta.json")):
+            with self.lock:
+                self.hits += 1
+            os.utime(os.path.join(path, "meta.json"))
+            return self._load(path)
+
+        with self.lock:
+            self.misses += 1
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._store(path, stage, params, build())
+        os.utime(os.path.join(path, "meta.json"))
+        self.evict(keep=path)
+        return self._load(path)
+
+    def entries(self):
+        """
+        List the cached entries.
+
+        Returns:
+        - list of tuple: (last use, size in bytes, path) for every entry, least recently used first.
+        """
+        result = []
+        for stage in sorted(os.listdir(self.directory)):
+            stage_dir = os.path.join(self.directory, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                path = os.path.join(stage_dir, key)
+                meta = os.path.join(path, "meta.json")
+                if ".tmp-" in key or not os.path.exists(meta):
+                    continue
+                size = sum(os.path.getsize(os.path.join(root, name))
+                           for root, _, names in os.walk(path) for name in names)
+                result.append((os.path.getmtime(meta), size, path))
+        return sorted(result)
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+
+        Parameters:
+        - keep (str, optional): An entry that is never removed, e.g. the one just stored.
+        """
+        if self.max_bytes is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _check_seeded(builder_params):
+    # `seed` only seeds the Poisson disk sampling; the objects come from the global np.random state
+    if builder_params.get("rng") is None or isinstance(builder_params["rng"], np.random.Generator):
+        raise ValueError("only scenes built from an int or SeedSequence rng can be cached")
+
+
+def _bind(function, kwargs):
+    """
+    The keyword arguments of a call with the defaults filled in, so that equal calls get equal keys.
+    """
+    bound = inspect.signature(function).bind(**kwargs)
+    bound.apply_defaults()
+    return dict(bound.arguments)
+
+
+def _normalize(builder_params, perturb):
+    builder_params = _bind(balls_and_eggs, builder_params)
+    if perturb is not None:
+        perturb = _bind(functools.partial(balls_and_eggs.perturb, None), perturb)
+    return builder_params, perturb
+
+
+def labels(cache, builder_params, perturb=None):
+    """
+    The filled scene of balls_and_eggs, cached.
+
+    Parameters:
+    - cache (scene_cache): The cache.
+    - builder_params (dict): Keyword arguments of balls_and_eggs, including an int or SeedSequence `rng`.
+      Defaults are filled in before hashing, so leaving out a default argument gives the same entry.
+    - perturb (dict, optional): Keyword arguments of balls_and_eggs.perturb; the perturbed scene
+      is returned if given.
+
+    Returns:
+    - dict: 'volume', 'instance_map' and 'class_map'.
+    """
+    _check_seeded(builder_params)
+    builder_params, perturb = _normalize(builder_params, perturb)
+
+    def build():
+        obj = balls_and_eggs(**builder_params)
+        volume, instance_map, class_map = obj.fill()
+        if perturb is not None:
+            obj.perturb(**perturb)
+            volume, instance_map, class_map = obj.fill()
+        return {"volume": volume, "instance_map": instance_map, "class_map": class_map}
+
+    return cache.get("labels", {"builder": builder_params, "perturb": perturb}, build)
+
+
+def blurred(cache, builder_params, sigma, perturb=None):
+    """
+    The blurred class probabilities of a scene (blur.blur_it), cached; reuses the cached labels.
+
+    Returns:
+    - dict: 'probabilities', of shape (C, N, N, N).
+    """
+    builder_params, perturb = _normalize(builder_params, perturb)
+
+    def build():
+        class_map = labels(cache, builder_params, perturb)["class_map"]
+        return {"probabilities": blur_it(np.asarray(class_map), sigma)}
+
+    params = {"builder": builder_params, "perturb": perturb, "sigma": sigma}
+    return cache.get("blurred", params, build)
+
+
+def modality_maps(cache, builder_params, sigma, composite, elements=["Si", "Ca", "Fe", "Al"], perturb=None):
+    """
+    The XCT and SEM-EDX maps of a scene (modalities.build_material_maps_XCT_SEM_EDX), cached;
+    reuses the cached blurred maps and labels.
+
+    Returns:
+    - dict: 'tomo' of shape (1, N, N, N) and 'sem' of shape (len(elements), N, N, N).
+    """
+    builder_params, perturb = _normalize(builder_params, perturb)
+
+    def build():
+        probabilities = blurred(cache, builder_params, sigma, perturb)["probabilities"]
+        tomo, sem, _ = build_material_maps_XCT_SEM_EDX(np.asarray(probabilities), composite, elements)
+        return {"tomo": tomo, "sem": sem}
+
+    params = {"builder": builder_params, "perturb": perturb, "sigma": sigma,
+              "composite": composite, "elements": list(elements)}
+    return cache.get("modalities", params, build)
@@ -0,0 +1,80 @@
+"""Chunked, out-of-core generation of balls_and_eggs volumes."""
+import itertools
+
+import numpy as np
+import dask
+import dask.array as da
+import zarr
+
+from mm3dtestdata import rasterizer
+
+
+def _fill_chunk(obj, table, shape, origin, tile_size, dtypes):
+    volume = np.zeros(shape, dtype=dtypes[0])
+    class_map = np.zeros(shape, dtype=dtypes[1])
+    instance_map = np.zeros(shape, dtype=dtypes[2])
+    obj.fill_block(volume, class_map, instance_map, origin=origin, table=table, tile_size=tile_size)
+    return volume, instance_map, class_map
+
+
+def fill_chunked(obj, chunks=128, store=None, tile_size=16, dtype=None, class_dtype=None, instance_dtype=None,
+                 **compute_kwargs):
+    """
+    Fill a balls_and_eggs scene chunk by chunk.
+
+    Parameters:
+    - obj: builder.balls_and_eggs
+        The scene to rasterize.
+    - chunks: int or tuple, optional
+        The chunk shape, in any form accepted by dask.
+    - store: str or zarr store, optional
+        If given, the chunks are computed and written to the arrays 'volume',
+        'instance_map' and 'class_map' of a zarr group at this location.
+    - tile_size: int, optional
+        Edge length of the tiles used by the batch rasterizer inside a chunk.
+    - dtype, class_dtype, instance_dtype: optional
+        Data types of the volume and the label maps, as in balls_and_eggs.fill.
+    - compute_kwargs:
+        Passed on to dask.compute when writing to a store, e.g. scheduler='processes'.
+
+    Returns:
+    - tuple
+        The volume, instance map and class map as in balls_and_eggs.fill; lazy
+        dask arrays if no store is given, otherwise the written zarr arrays.
+
+    Every chunk is rasterized on its own and only receives the objects whose
+    bounding boxes intersect it, so the full volume never has to fit in memory.
+    The result is identical to balls_and_eggs.fill.
+    """
+    N = int(obj.scale)
+    shape = (N, N, N)
+    chunks = da.core.normalize_chunks(chunks, shape)
+    dtypes = obj._fill_dtypes(dtype, class_dtype, instance_dtype)
+    table = obj.object_table()
+    scene = dask.delayed(obj, pure=False)
+
+    starts = [np.cumsum((0,) + c[:-1]) for c in chunks]
+    blocks = np.empty([len(c) for c in chunks], dtype=object)
+    for index in itertools.product(*[range(len(c)) for c in chunks]):
+        origin = tuple(int(starts[axis][i]) for axis, i in enumerate(index))
+        block_shape = tuple(chunks[axis][i] for axis, i in enumerate(index))
+        subset = rasterizer.subset_table(table, rasterizer.intersecting(table, block_shape, origin))
+        parts = dask.delayed(_fill_chunk, nout=3)(scene, subset, block_shape, origin, tile_size, dtypes)
+        blocks[index] = [da.from_delayed(parts[0], block_shape, dtype=dtypes[0]),
+                         da.from_delayed(parts[1], block_shape, dtype=dtypes[2]),
+                         da.from_delayed(parts[2], block_shape, dtype=dtypes[1])]
+
+    arrays = [da.block([[[blocks[i, j, k][n] for k in range(blocks.shape[2])]
+                         for j in range(blocks.shape[1])]
+                        for i in range(blocks.shape[0])])
+              for n in range(3)]
+
+    if store is None:
+        return tuple(arrays)
+
+    names = ["volume", "instance_map", "class_map"]
+    writes = [da.to_zarr(array, store, component=name, overwrite=True, compute=False)
+              for array, name in zip(arrays, names)]
+    dask.compute(*writes, **compute_kwargs)
+    root = zarr.open_group(store, mode="r")
+    return tuple(root[name] for name in names)
@@ -1,17 +1,156 @@
+import itertools
+import os
+import threading
 import numpy as np
-from scipy.spatial.distance import cdist
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import csr_matrix
 from scipy.interpolate import RegularGridInterpolator
-from scipy.stats.qmc import PoissonDisk
-from mm3dtestdata import fillers
-from mm3dtestdata import builder
 import einops
 
 
+class slice_plan(object):
+    def __init__(self, stencil, shape):
+        """
+        A reusable interpolation plan for one plane geometry and volume shape.
+
+        Parameters:
+        stencil (tuple): Indices, weights and mask as returned by schaaf.interpolation_stencil.
+        shape (tuple): Shape of the (single channel) volume the stencil was built for.
+        """
+        flat, weights, valid = stencil
+        flat = np.where(valid[:, None], flat, 0)
+        weights = np.where(valid[:, None], weights, 0.0)
+        size = int(np.prod(shape))
+        self.shape = tuple(shape)
+        self.valid = valid
+        self.matrix = csr_matrix((weights.ravel(), flat.ravel(), np.arange(0, flat.size + 1, flat.shape[1])),
+                                 shape=(len(valid), size))
+        self.matrix.sum_duplicates()
+        self.matrix.eliminate_zeros()
+
+    @property
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes + self.valid.nbytes
+
+    def apply(self, data):
+        """
+        Interpolate all channels of a volume with one sparse matrix product.
+
+        Parameters:
+        data (np.array): 3D volume, or 4D volume with shape (C, N, N, N), matching the plan's shape.
+
+        Returns:
+        np.array: Interpolated values of shape (P,) or (C, P); NaN outside the volume.
+        """
+        assert tuple(data.shape[-3:]) == self.shape
+        channels = data.reshape((-1, int(np.prod(self.shape))))
+        values = np.asarray(self.matrix @ channels.T, dtype=float).T
+        values[:, ~self.valid] = np.nan
+        if data.ndim == 3:
+            return values[0]
+        return values
+
+
+class memory_cache(object):
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        """
+        A least recently used cache with a memory budget, for slice plans and volume chunks.
+
+        Parameters:
+        max_bytes (int): The total nbytes of the cached items is kept below this budget;
+            0 disables caching.
+        """
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """
+        Return the item stored under key, building and caching it with build() on a miss.
+        """
+        with self.lock:
+            if key in self.items:
+                self.hits += 1
+                self.items.move_to_end(key)
+                return self.items[key]
+            self.misses += 1
+        item = build()
+        with self.lock:
+            if item.nbytes <= self.max_bytes and key not in self.items:
+                self.items[key] = item
+                self.nbytes += item.nbytes
+                while self.nbytes > self.max_bytes:
+                    _, evicted = self.items.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+        return item
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+
+def _chunk_boundaries(data):
+    """
+    Return the chunk boundaries along each axis of a dask or zarr array.
+    """
+    boundaries = []
+    for n, chunks in zip(data.shape, data.chunks):
+        if np.ndim(chunks) == 0:
+            boundaries.append(np.arange(0, n + chunks, chunks).clip(max=n))
+        else:
+            boundaries.append(np.concatenate([[0], np.cumsum(chunks)]))
+    return boundaries
+
+
+def _source_key(data):
+    """
+    Identify the array a chunk was read from, for the chunk cache.
+    """
+    if hasattr(data, "dask"):
+        return data.name
+    store_path = getattr(data, "store_path", None)
+    if store_path is not None:
+        return str(store_path)
+    return id(getattr(data, "store", data)), getattr(data, "path", "")
+
+
+def _chunk_version(data, key):
+    """
+    Tell rewritten chunks apart in the chunk cache: for a zarr array in a local store, the inode,
+    modification time and size of the files that hold the chunk with spatial index key (all channels,
+    shards if sharded); zarr replaces a file on every write.
+    None for other arrays, whose chunks are cached until schaaf.chunks.clear() is called.
+    """
+    root = getattr(getattr(getattr(data, "store_path", None), "store", None), "root", None)
+    if root is None:
+        return None
+    grid = getattr(data, "shards", None) or data.chunks
+    lead = [range(-(-n // c)) for n, c in zip(data.shape[:-3], grid[:-3])]
+    spatial = tuple(k * c // g for k, c, g in zip(key, data.chunks[-3:], grid[-3:]))
+    versions = []
+    for channel in itertools.product(*lead):
+        path = os.path.join(str(root), data.store_path.path,
+                            data.metadata.encode_chunk_key(channel + spatial))
+        try:
+            stat = os.stat(path)
+            versions.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            versions.append(None)
+    return tuple(versions)
+
+
 class schaaf(object):
-    def __init__(self, shape):
+    def __init__(self, shape, plan_cache_bytes=256 * 2 ** 20, chunk_cache_bytes=64 * 2 ** 20):
         self.shape = shape
         if len(shape)==4:
             self.shape = shape[1:]
+        self.plans = memory_cache(plan_cache_bytes)
+        self.chunks = memory_cache(chunk_cache_bytes)
 
 
     def plane_equation(self, normal, point):
@@ -95,6 +234,146 @@ class schaaf(object):
 
         return interpolated_values
 
+    def interpolation_stencil(self, plane_points, shape, method="linear"):
+        """
+        Precompute the voxels and weights needed to interpolate a block at plane_points.
+
+        Parameters:
+        plane_points (np.array): Points on the plane, shape (P, 3).
+        shape (tuple): Shape of the (single channel) block.
+        method (str): Interpolation method - 'linear' or 'nearest'.
+
+        Returns:
+        np.array: Flattened voxel indices of shape (P, K), with K = 8 for 'linear' and 1 for 'nearest'.
+        np.array: Weights of shape (P, K).
+        np.array: Boolean mask of shape (P,) flagging points inside the block.
+
+        The stencil follows scipy's RegularGridInterpolator on the grid np.arange(n) per axis,
+        so applying it (see apply_stencil) gives the same values as interpolate_block_scipy.
+        """
+        plane_points = np.asarray(plane_points, dtype=float)
+        upper = np.asarray(shape) - 1
+        valid = np.all((plane_points >= 0) & (plane_points <= upper), axis=1)
+        points = np.where(valid[:, None], plane_points, 0)
+
+        lower = np.clip(np.floor(points).astype(int), 0, np.maximum(upper - 1, 0))
+        fraction = points - lower
+
+        if method == "nearest":
+            index = lower + (fraction > 0.5)
+            flat = np.ravel_multi_index(tuple(index.T), shape)
+            return flat[:, None], np.ones((len(points), 1)), valid
+
+        if method != "linear":
+            raise ValueError("Unsupported stencil method %s" % method)
+
+        corners = np.array(list(np.ndindex(2, 2, 2)))
+        index = np.minimum(lower[:, None, :] + corners[None, :, :], upper)
+        weights = np.prod(np.where(corners[None, :, :] == 1, fraction[:, None, :], 1 - fraction[:, None, :]), axis=2)
+        flat = np.ravel_multi_index(tuple(np.moveaxis(index, -1, 0)), shape)
+        return flat, weights, valid
+
+    def apply_stencil(self, stencil, data):
+        """
+        Interpolate all channels of a block with a precomputed stencil in one gather.
+
+        Parameters:
+        stencil (tuple): Indices, weights and mask as returned by interpolation_stencil.
+        data (np.array, zarr or dask array): 3D block, or 4D block with shape (C, N, N, N).
+            For zarr and dask arrays only the chunks the stencil touches are read.
+
+        Returns:
+        np.array: Interpolated values of shape (P,) or (C, P); NaN outside the block.
+        """
+        flat, weights, valid = stencil
+        if isinstance(data, np.ndarray):
+            channels = data.reshape((-1, int(np.prod(data.shape[-3:]))))
+            gathered = channels[:, flat]
+        else:
+            gathered = self.gather_chunked(flat, valid, data)
+        values = np.einsum("cpk,pk->cp", gathered, weights)
+        values[:, ~valid] = np.nan
+        if data.ndim == 3:
+            return values[0]
+        return values
+
+    def gather_chunked(self, flat, valid, data):
+        """
+        Gather voxels from a chunked (zarr or dask) array, reading only the chunks that hold them.
+
+        Chunks are kept in the LRU cache self.chunks, so neighbouring planes reuse them. For zarr arrays
+        in a local store the state of the chunk files is part of the key, so rewritten
+        chunks are read again; for dask arrays and other stores, call self.chunks.clear() after the
+        data changed in place.
+
+        Parameters:
+        flat (np.array): Flattened voxel indices of shape (P, K) into the spatial shape of data.
+        valid (np.array): Boolean mask of shape (P,); invalid rows are not read.
+        data (zarr or dask array): 3D array, or 4D array with shape (C, N, N, N).
+
+        Returns:
+        np.array: The voxel values, of shape (C, P, K); zero for invalid rows.
+        """
+        spatial = tuple(data.shape[-3:])
+        channels = 1 if data.ndim == 3 else data.shape[0]
+        gathered = np.zeros((channels,) + flat.shape, dtype=np.result_type(data.dtype, np.float64))
+
+        rows, columns = np.nonzero(np.broadcast_to(valid[:, None], flat.shape))
+        index = np.unravel_index(flat[rows, columns], spatial)
+        boundaries = _chunk_boundaries(data)[-3:]
+        chunk = np.column_stack([np.searchsorted(b, i, side="right") - 1 for b, i in zip(boundaries, index)])
+        source = _source_key(data)
+
+        order = np.lexsort(chunk.T[::-1])
+        chunk = chunk[order]
+        splits = np.flatnonzero(np.any(np.diff(chunk, axis=0) != 0, axis=1)) + 1
+        for group in np.split(np.arange(len(order)), splits):
+            if group.size == 0:
+                continue
+            key = tuple(int(c) for c in chunk[group[0]])
+            box = tuple(slice(b[c], b[c + 1]) for b, c in zip(boundaries, key))
+
+            def read():
+                block = data[(Ellipsis,) + box]
+                if hasattr(block, "compute"):
+                    block = block.compute()
+                return np.asarray(block).reshape((channels,) + tuple(s.stop - s.start for s in box))
+
+            block = self.chunks.get((source, key, _chunk_version(data, key)), read)
+            members = order[group]
+            local = tuple(i[members] - s.start for i, s in zip(index, box))
+            gathered[:, rows[members], columns[members]] = block[(slice(None),) + local]
+        return gathered
+
+    def slice_plan(self, normal, point, N, spacing, shape, method="linear"):
+        """
+        Get the interpolation plan of a plane for volumes of a given shape.
+
+        Plans are keyed by (normal, point, N, spacing, method, shape) and kept in the LRU cache
+        self.plans, so re-slicing any volume of the same shape at the same plane reuses them.
+
+        Parameters:
+        normal (tuple): Normal vector of the plane.
+        point (tuple): A point on the plane.
+        N (int): Size of the grid to sample on the plane.
+        spacing (float): Spacing between grid points.
+        shape (tuple): Shape of the volume, (N, N, N) or (C, N, N, N).
+        method (str): Interpolation method - 'linear' or 'nearest'.
+
+        Returns:
+        slice_plan: The plan.
+        """
+        shape = tuple(int(n) for n in shape[-3:])
+        key = (tuple(float(v) for v in normal), tuple(float(v) for v in point), int(N), float(spacing),
+               method, shape)
+
+        def build():
+            plane_eq = self.plane_equation(normal, point)
+            plane_points, _ = self.sample_plane(plane_eq, point, N, spacing)
+            return slice_plan(self.interpolation_stencil(plane_points, shape, method), shape)
+
+        return self.plans.get(key, build)
+
     def _plakje(self, normal, point, N, spacing, data, method="linear"):
         plane_eq = self.plane_equation(normal, point)
         plane_points, _ = self.sample_plane(plane_eq, point, N, spacing)
@@ -106,17 +385,33 @@ class schaaf(object):
         """
         Interpolate values from a multi-channel 3D block at the positions defined by plane_points.
 
+        For 'linear' and 'nearest' interpolation the neighbour indices and weights are computed
+        once per plane, cached as a slice plan (see slice_plan) and applied to all channels in a
+        single sparse matrix product.
+
         Parameters:
         normal (tuple): Normal vector of the plane.
         point (tuple): A point on the plane.
         N (int): Size of the grid to sample on the plane.
         spacing (float): Spacing between grid points.
-        data (np.array): 4D array representing the block, with shape (C, N, N, N).
+        data (np.array): 4D array representing the block, with shape (C, N, N, N). Zarr and dask
+            arrays are sliced out of core: only the chunks the plane crosses are read.
         method (str): Interpolation method - 'linear', 'nearest', etc.
 
         Returns:
         np.array: Interpolated values at the plane points for each channel, with shape (C, M, M, M).
         """
+        if method in ("linear", "nearest"):
+            if isinstance(data, np.ndarray):
+                f = self.slice_plan(normal, point, N, spacing, data.shape, method).apply(data)
+            else:
+                plane_eq = self.plane_equation(normal, point)
+                plane_points, _ = self.sample_plane(plane_eq, point, N, spacing)
+                f = self.apply_stencil(self.interpolation_stencil(plane_points, data.shape[-3:], method), data)
+            if len(data.shape) == 3:
+                return einops.rearrange(f, "(X Y) -> Y X", X=N, Y=N)
+            return einops.rearrange(f, "C (X Y) -> C Y X", X=N, Y=N)
+
         plane_eq = self.plane_equation(normal, point)
         plane_points, _ = self.sample_plane(plane_eq, point, N, spacing)
 
@@ -135,3 +430,43 @@ class schaaf(object):
         # Stack the interpolated results along a new axis
         return np.stack(interpolated_channels)
 
+    def plakje_stack(self, normal, points, N, spacing, data, method="linear", workers=None):
+        """
+        Interpolate a stack of parallel sections, e.g. to emulate serial sectioning.
+
+        The in-plane lattice of a plane does not depend on the point it is centered on, so it is
+        sampled once and shifted to every point; for points moved along the normal this is a shift
+        along the normal. Each section is then interpolated with a single stencil gather.
+
+        Parameters:
+        normal (tuple): Normal vector shared by all sections.
+        points (np.array): The points the sections pass through, shape (K, 3).
+        N (int): Size of the grid to sample on each section.
+        spacing (float): Spacing between grid points.
+        data (np.array, zarr or dask array): 3D block, or 4D block with shape (C, N, N, N).
+        method (str): Interpolation method - 'linear' or 'nearest'.
+        workers (int, optional): Number of threads to spread the sections over.
+
+        Returns:
+        np.array: The sections, with shape (K, C, N, N), or (K, N, N) for a 3D block; each equal to
+        plakje(normal, points[k], N, spacing, data, method) up to rounding (which can only matter
+        for sample points that fall exactly on the block boundary).
+        """
+        origin = (0.0, 0.0, 0.0)
+        lattice, _ = self.sample_plane(self.plane_equation(normal, origin), origin, N, spacing)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        result = np.empty((len(points),) + data.shape[:-3] + (N, N))
+
+        def section(k):
+            stencil = self.interpolation_stencil(lattice + points[k], data.shape[-3:], method)
+            f = self.apply_stencil(stencil, data).reshape(data.shape[:-3] + (N, N))
+            result[k] = np.swapaxes(f, -1, -2)
+
+        if workers is None or workers <= 1:
+            for k in range(len(points)):
+                section(k)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(section, range(len(points))))
+        return result
+
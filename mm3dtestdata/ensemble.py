@@ -0,0 +1,241 @@
+"""Generate ensembles of balls_and_eggs datasets in a process pool."""
+import argparse
+import inspect
+import itertools
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from mm3dtestdata import seeding
+from mm3dtestdata.builder import balls_and_eggs
+from mm3dtestdata.modalities import blur_and_project
+from mm3dtestdata.noise import noise
+
+BUILDER_PARAMETERS = [name for name in inspect.signature(balls_and_eggs).parameters
+                      if name not in ("seed", "rng")]
+
+PIPELINE_DEFAULTS = {"perturb": None,
+                     "sigma": 1.0,
+                     "composite": "VEQI",
+                     "elements": ["Si", "Ca", "Fe", "Al"],
+                     "noise_factor": 0.2,
+                     "dark_noise": 0.05}
+
+
+def parameter_grid(grid):
+    """
+    Expand a parameter grid into a list of parameter sets.
+
+    Parameters:
+    - grid (dict): Maps parameter names to a list of options. A value that is not a list is
+      taken as the only option.
+
+    Returns:
+    - list of dict: Every combination of options, in the order of the grid's keys.
+    """
+    keys = list(grid)
+    options = [grid[key] if isinstance(grid[key], list) else [grid[key]] for key in keys]
+    return [dict(zip(keys, values)) for values in itertools.product(*options)]
+
+
+def generate_scene(params, seed, allocate=None):
+    """
+    Run the full generation pipeline for one scene.
+
+    The scene is built with balls_and_eggs, filled, optionally perturbed and filled again. The final
+    class map is blurred and projected onto XCT and SEM-EDX channels, and noise is added to both.
+
+    Parameters:
+    - params (dict): balls_and_eggs keyword arguments plus the pipeline parameters 'perturb'
+      (keyword arguments for balls_and_eggs.perturb, or None), 'sigma', 'composite', 'elements',
+      'noise_factor' and 'dark_noise'.
+    - seed (int or SeedSequence): Seed of the scene; all random streams are spawned from it.
+    - allocate (callable, optional): Called as allocate(name, shape, dtype) for every returned array
+      before it is computed; the pipeline writes straight into the arrays it returns. np.empty by
+      default.
+
+    Returns:
+    - dict of numpy.ndarray: 'class_map' and 'instance_map' of the unperturbed scene,
+      'perturbed_class_map' and 'perturbed_instance_map' if a perturbation was given, and the noisy
+      'xct' and 'sem' maps of the final scene.
+    """
+    unknown = set(params) - set(BUILDER_PARAMETERS) - set(PIPELINE_DEFAULTS)
+    if unknown:
+        raise ValueError("unknown scene parameters: %s" % ", ".join(sorted(unknown)))
+    pipeline = dict(PIPELINE_DEFAULTS)
+    pipeline.update((key, value) for key, value in params.items() if key in PIPELINE_DEFAULTS)
+    builder_kwargs = {key: value for key, value in params.items() if key in BUILDER_PARAMETERS}
+    if allocate is None:
+        def allocate(name, shape, dtype):
+            return np.empty(shape, dtype=dtype)
+
+    builder_seed, xct_seed, sem_seed = seeding.seed_sequence(seed).spawn(3)
+    obj = balls_and_eggs(rng=builder_seed, **builder_kwargs)
+    shape = (int(obj.scale),) * 3
+    dtype, class_dtype, instance_dtype = obj._fill_dtypes(None, None, None)
+    volume = np.empty(shape, dtype=dtype)
+    result = {"class_map": allocate("class_map", shape, class_dtype),
+              "instance_map": allocate("instance_map", shape, instance_dtype)}
+    obj.fill(out=(volume, result["instance_map"], result["class_map"]))
+    class_map = result["class_map"]
+    if pipeline["perturb"] is not None:
+        obj.perturb(**pipeline["perturb"])
+        result["perturbed_class_map"] = allocate("perturbed_class_map", shape, class_dtype)
+        result["perturbed_instance_map"] = allocate("perturbed_instance_map", shape, instance_dtype)
+        obj.fill(out=(volume, result["perturbed_instance_map"], result["perturbed_class_map"]))
+        class_map = result["perturbed_class_map"]
+    del volume
+
+    elements = pipeline["elements"]
+    xct = result["xct"] = allocate("xct", (1,) + shape, dtype)
+    sem = result["sem"] = allocate("sem", (len(elements),) + shape, dtype)
+    blur_and_project(class_map, pipeline["sigma"], pipeline["composite"], elements, out=(xct, sem))
+    noise(xct, pipeline["noise_factor"], pipeline["dark_noise"], rng=xct_seed, out=xct, add=True)
+    noise(sem, pipeline["noise_factor"], pipeline["dark_noise"], rng=sem_seed, out=sem, add=True)
+    return result
+
+
+def _run_scene(params, seed):
+    """
+    Generate a scene in a worker, straight into shared memory blocks the parent takes over.
+    """
+    blocks = {}
+
+    def allocate(name, shape, dtype):
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        blocks[name] = (block, shape, dtype)
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    try:
+        generate_scene(params, seed, allocate)
+    except BaseException:
+        for block, _, _ in blocks.values():
+            block.unlink()
+            try:
+                block.close()
+            except BufferError:
+                # the traceback still holds views; the mapping goes away with the block
+                pass
+        raise
+    descriptors = {}
+    for name, (block, shape, dtype) in blocks.items():
+        descriptors[name] = (block.name, shape, dtype.str)
+        block.close()
+        # the parent process takes ownership and unlinks the block once it is written
+        if os.name == "posix":
+            resource_tracker.unregister("/" + block.name, "shared_memory")
+    return descriptors
+
+
+def _release_scene(descriptors):
+    """
+    Unlink the shared memory of a scene that will not be written.
+    """
+    for descriptor in descriptors.values():
+        block = shared_memory.SharedMemory(name=descriptor[0])
+        block.close()
+        block.unlink()
+
+
+def _write_scene(out_dir, index, params, seed, descriptors):
+    """
+    Write a scene held in shared memory to disk and release the shared memory.
+    """
+    blocks = {name: shared_memory.SharedMemory(name=descriptor[0]) for name, descriptor in descriptors.items()}
+    try:
+        arrays = {name: np.ndarray(descriptors[name][1], dtype=descriptors[name][2], buffer=block.buf)
+                  for name, block in blocks.items()}
+        path = os.path.join(out_dir, "scene_%05d.npz" % index)
+        np.savez(path, **arrays)
+        del arrays
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+    with open(os.path.join(out_dir, "scene_%05d.json" % index), "w") as handle:
+        json.dump({"params": params, "seed": seed}, handle, indent=1)
+    return path
+
+
+def run_ensemble(grid, seeds, out_dir, workers=None):
+    """
+    Generate one scene per combination of grid parameters and seeds in a process pool.
+
+    Every worker runs generate_scene and returns its arrays in shared memory; each scene is written
+    to out_dir as scene_#####.npz (plus a .json file with its parameters and seed) as soon as it is
+    done.
+
+    Parameters:
+    - grid (dict): The parameter grid, see parameter_grid.
+    - seeds (list of int): The seeds to run every parameter set with.
+    - out_dir (str): Output directory; created if needed.
+    - workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+    - list of str: The written .npz files, in the order of the jobs.
+    """
+    jobs = [(params, seed) for params in parameter_grid(grid) for seed in seeds]
+    os.makedirs(out_dir, exist_ok=True)
+    paths = [None] * len(jobs)
+    workers = os.cpu_count() if workers is None else workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # at most 2 * workers scenes are in flight, so finished ones cannot pile up in shared memory
+        pending = {}
+        submitted = iter(enumerate(jobs))
+        try:
+            while True:
+                for index, (params, seed) in itertools.islice(submitted, 2 * workers - len(pending)):
+                    pending[pool.submit(_run_scene, params, seed)] = index
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    params, seed = jobs[index]
+                    paths[index] = _write_scene(out_dir, index, params, seed, future.result())
+        finally:
+            # on an error, drain the remaining scenes so that no shared memory outlives the run
+            for future in pending:
+                future.cancel()
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    _release_scene(future.result())
+    return paths
+
+
+def _parse_seeds(text):
+    if ":" in text:
+        return list(range(*[int(value) for value in text.split(":")]))
+    return [int(value) for value in text.split(",")]
+
+
+def main(argv=None):
+    """
+    Console entry point: mm3d-ensemble --grid GRID --seeds SEEDS --out DIR [--workers N]
+    """
+    parser = argparse.ArgumentParser(description="Generate an ensemble of balls_and_eggs datasets.")
+    parser.add_argument("--grid", default="{}",
+                        help="parameter grid as a JSON string or the path of a JSON file")
+    parser.add_argument("--seeds", default="0",
+                        help="comma separated seeds, or a range as start:stop[:step]")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    if os.path.isfile(args.grid):
+        with open(args.grid) as handle:
+            grid = json.load(handle)
+    else:
+        grid = json.loads(args.grid)
+
+    for path in run_ensemble(grid, _parse_seeds(args.seeds), args.out, args.workers):
+        print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
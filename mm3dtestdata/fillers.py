@@ -1,7 +1,76 @@
 """Main module."""
-from scipy.stats.qmc import PoissonDisk
 import numpy as np
-from scipy.spatial.distance import cdist
+
+
+def bounding_box(center, half_widths, shape):
+    """
+    Compute the clipped axis-aligned bounding box of an object.
+
+    Parameters:
+    - center: tuple of float
+        The (x, y, z) coordinates of the object's center.
+    - half_widths: tuple of float
+        The half extent of the object along each axis.
+    - shape: tuple of int
+        The shape of the volume the box is clipped against.
+
+    Returns:
+    - tuple of slice or None
+        Slices selecting the box inside the volume, or None if the box lies
+        entirely outside of it.
+
+    The box is padded by a voxel on each side so that it always contains every
+    grid point that can satisfy a strict membership test.
+    """
+    box = []
+    for c, h, n in zip(center, half_widths, shape):
+        lo = max(int(np.floor(c - h)), 0)
+        hi = min(int(np.ceil(c + h)) + 1, n)
+        if hi <= lo:
+            return None
+        box.append(slice(lo, hi))
+    return tuple(box)
+
+
+def box_coordinates(box, origin=(0, 0, 0)):
+    """
+    Build broadcastable grid coordinates for a bounding box.
+
+    Parameters:
+    - box: tuple of slice
+        The box as returned by bounding_box.
+    - origin: tuple of int, optional
+        The position of the array's first voxel when it is a block of a larger volume.
+
+    Returns:
+    - tuple of numpy.ndarray
+        Open (x, y, z) index grids in volume coordinates, shaped to broadcast
+        against each other like np.ogrid.
+    """
+    x = np.arange(box[0].start, box[0].stop)[:, None, None] + origin[0]
+    y = np.arange(box[1].start, box[1].stop)[None, :, None] + origin[1]
+    z = np.arange(box[2].start, box[2].stop)[None, None, :] + origin[2]
+    return x, y, z
+
+
+def ellipsoid_half_widths(major_axis, minor_axis, rotation_matrix):
+    """
+    Compute the axis-aligned half extents of a rotated ellipsoid.
+
+    Parameters:
+    - major_axis: float
+        The length of the ellipsoid's major axis.
+    - minor_axis: float
+        The length of the ellipsoid's minor axes.
+    - rotation_matrix: 3x3 numpy.ndarray
+        The rotation matrix used by fill_ellipsoid.
+
+    Returns:
+    - numpy.ndarray
+        The half extent of the ellipsoid along x, y and z.
+    """
+    axes = np.array([major_axis, minor_axis, minor_axis], dtype=float)
+    return np.sqrt(np.sum((np.asarray(rotation_matrix) * axes[:, None]) ** 2, axis=0))
 
 
 def fill_sphere(center, radius, volume, class_map, instance_map, instance_label, class_label=2, density=1.0):
@@ -31,18 +100,25 @@ def fill_sphere(center, radius, volume, class_map, instance_map, instance_label,
     and sets their corresponding locations in 'volume' and 'class_map' and 'instance_map' narrays.
     """
     assert radius > 1
-    x, y, z = np.indices(volume.shape)
+    box = bounding_box(center, (radius, radius, radius), volume.shape)
+    if box is None:
+        return
+    x, y, z = box_coordinates(box)
     dist_sq = (x - center[0]) ** 2 + (y - center[1]) ** 2 + (z - center[2]) ** 2
     inside_sphere = dist_sq < (radius ** 2)
-    volume[inside_sphere] = density
-    class_map[inside_sphere] = class_label
-    instance_map[inside_sphere] = instance_label
+    volume[box][inside_sphere] = density
+    class_map[box][inside_sphere] = class_label
+    instance_map[box][inside_sphere] = instance_label
 
 
-def random_rotation_matrix():
+def random_rotation_matrix(rng=None):
     """
     Generate a random 3D rotation matrix using quaternions.
 
+    Parameters:
+    - rng: numpy.random.Generator, optional
+        The generator to draw from. Default is the global np.random state.
+
     Returns:
     - numpy.ndarray
         A 3x3 numpy array representing the rotation matrix.
@@ -51,7 +127,7 @@ def random_rotation_matrix():
     rotation in 3D space, using quaternions to ensure uniform sampling from SO(3).
     """
     # Generate random quaternion components from a normal distribution
-    quaternion = np.random.normal(size=4)
+    quaternion = (np.random if rng is None else rng).normal(size=4)
 
     # Normalize the quaternion to unit length
     quaternion /= np.linalg.norm(quaternion)
@@ -78,7 +154,8 @@ def fill_ellipsoid(center,
                    instance_label,
                    rotation_matrix=None,
                    class_label=3,
-                   density=1.0):
+                   density=1.0,
+                   rng=None):
     """
     Fill an ellipsoidal region in a 3D volume.
 
@@ -103,39 +180,75 @@ def fill_ellipsoid(center,
         The instance label to assign to the sphere region. Default is 3.
     - density: float, optional
         The density value of the pixel in the volume
+    - rng: numpy.random.Generator, optional
+        The generator used for the random rotation when no rotation_matrix is given.
 
     This function applies a random rotation to the ellipsoid and identifies
     all points inside the rotated ellipsoid to set their corresponding locations
     in 'volume' and 'class_map' and 'instance_map' arrays.
     """
 
-    x, y, z = np.indices(volume.shape).astype(float)
-    x -= center[0]
-    y -= center[1]
-    z -= center[2]
     if rotation_matrix is None:
-        rotation_matrix = random_rotation_matrix()
-
-    rotated_coords = np.dot(rotation_matrix, np.array([x.ravel(), y.ravel(), z.ravel()]))
-    x_rotated, y_rotated, z_rotated = rotated_coords.reshape(3, *volume.shape)
+        rotation_matrix = random_rotation_matrix(rng=rng)
+
+    box = bounding_box(center,
+                       ellipsoid_half_widths(major_axis, minor_axis, rotation_matrix),
+                       volume.shape)
+    if box is None:
+        return
+    x, y, z = box_coordinates(box)
+    x = x - center[0]
+    y = y - center[1]
+    z = z - center[2]
+
+    r = rotation_matrix
+    x_rotated = r[0, 0] * x + r[0, 1] * y + r[0, 2] * z
+    y_rotated = r[1, 0] * x + r[1, 1] * y + r[1, 2] * z
+    z_rotated = r[2, 0] * x + r[2, 1] * y + r[2, 2] * z
     dist_sq_x = (x_rotated / major_axis) ** 2
     dist_sq_y = (y_rotated / minor_axis) ** 2
     dist_sq_z = (z_rotated / minor_axis) ** 2
     inside_ellipsoid = dist_sq_x + dist_sq_y + dist_sq_z < 1
-    volume[inside_ellipsoid] = density
-    class_map[inside_ellipsoid] = class_label
-    instance_map[inside_ellipsoid] = instance_label
+    volume[box][inside_ellipsoid] = density
+    class_map[box][inside_ellipsoid] = class_label
+    instance_map[box][inside_ellipsoid] = instance_label
 
 
 def matrix(center, radius, volume, class_map, instance_map, instance_label, class_label=1, density=0.5, sel_label=2):
-    tmp_volume = np.zeros_like(volume)
-    tmp_class_map = np.zeros_like(class_map)
-    tmp_instance_map = np.zeros_like(instance_map)
-    fill_sphere(center, radius,
-                tmp_volume, tmp_class_map, tmp_instance_map,
-                instance_label=instance_label, class_label=class_label, density=density)
-    sel = (class_map < sel_label) & (tmp_class_map > 0)
-    volume[sel] = tmp_volume[sel]
-    class_map[sel] = tmp_class_map[sel]
-    instance_map[sel] = tmp_instance_map[sel]
+    """
+    Fill the background inside a sphere with matrix material, in place.
+
+    Parameters:
+    - center: tuple of float
+        The (x, y, z) coordinates of the sphere's center.
+    - radius: float
+        The radius of the sphere.
+    - volume, class_map, instance_map: numpy.ndarray
+        The 3D arrays to draw into.
+    - instance_label, class_label: int
+        The labels to assign to the matrix.
+    - density: float, optional
+        The density value of the matrix in the volume.
+    - sel_label: int, optional
+        Only voxels with a class label below this value are overwritten.
+
+    The volume is visited one slab at a time, so no full-size temporaries are made, and the
+    distance test is skipped when the sphere covers the whole volume.
+    """
+    assert radius > 1
+    if class_label <= 0:
+        return
+    box = bounding_box(center, (radius, radius, radius), volume.shape)
+    if box is None:
+        return
+    x, y, z = box_coordinates(box)
+    reach = sum(max((b.start - c) ** 2, (b.stop - 1 - c) ** 2) for b, c in zip(box, center))
+    covered = reach < radius ** 2
+    for i in x.ravel():
+        sel = class_map[i, box[1], box[2]] < sel_label
+        if not covered:
+            sel &= (i - center[0]) ** 2 + (y[0] - center[1]) ** 2 + (z[0] - center[2]) ** 2 < radius ** 2
+        volume[i, box[1], box[2]][sel] = density
+        class_map[i, box[1], box[2]][sel] = class_label
+        instance_map[i, box[1], box[2]][sel] = instance_label
 
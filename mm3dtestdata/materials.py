@@ -1,4 +1,3 @@
-import torch
 import numpy as np
 
 materials_data = [
@@ -112,6 +111,96 @@ composite_materials = [
     },
 ]
 
+class MaterialRegistry(object):
+    """
+    The material and composite tables compiled into dense arrays for fast lookups.
+
+    Every material is a row of a (materials x properties) matrix, with indexes from material name to
+    row, property to column and element to the columns of its atom densities. Composite action
+    matrices are memoized per (composite, elements) pair, so after the first call building them is a
+    dictionary lookup.
+
+    Parameters:
+    - materials (list): Material dicts, as materials_data.
+    - composites (list): Composite dicts, as composite_materials; the int keys give the class labels.
+    """
+    def __init__(self, materials=materials_data, composites=composite_materials):
+        self.materials = materials
+        self.properties = []
+        for material in materials:
+            for key, value in material.items():
+                if key not in self.properties and isinstance(value, (int, float)):
+                    self.properties.append(key)
+        self.column = {key: column for column, key in enumerate(self.properties)}
+        self.table = np.array([[material.get(key, 0.0) for key in self.properties] for material in materials],
+                              dtype=float)
+
+        self.row = {}
+        for row, material in enumerate(materials):
+            self.row.setdefault(material["Material"], row)
+
+        # element columns are matched on the first two characters of the property name, e.g. "Si", " K"
+        self.element_columns = {}
+        for column, key in enumerate(self.properties):
+            self.element_columns.setdefault(key[0:2], []).append(column)
+
+        self.composites = {}
+        for composite in composites:
+            self.composites[composite["Name"]] = [composite[key] for key in composite if type(key) is int]
+
+        self._actions = {}
+
+    def material(self, name):
+        """
+        Return the dict of a material, or None if there is no such material.
+        """
+        row = self.row.get(name)
+        return None if row is None else self.materials[row]
+
+    def composite_rows(self, composite_name):
+        """
+        Return the table rows of the components of a composite, in class label order.
+        """
+        if composite_name not in self.composites:
+            raise KeyError("composite material %s not found" % composite_name)
+        names = self.composites[composite_name]
+        missing = [name for name in names if name not in self.row]
+        if missing:
+            raise KeyError("materials %s of composite %s not found" % (", ".join(missing), composite_name))
+        return np.array([self.row[name] for name in names])
+
+    def actions(self, composite_name, elements):
+        """
+        Return the XCT and SEM-EDX class actions of a composite; memoized.
+
+        Parameters:
+        - composite_name (str): The name of the composite material.
+        - elements (list): The elements of the spectral channels. An element listed twice only
+          fills its first channel.
+
+        Returns:
+        - tuple: Read-only arrays of shape (1, C) with the electron densities and (len(elements), C)
+          with the atom densities of the C components.
+        """
+        key = (composite_name, tuple(elements))
+        if key not in self._actions:
+            components = self.table[self.composite_rows(composite_name)]
+            tomo = components[:, self.column["Electron Density (electrons/nm3)"]][np.newaxis, :]
+
+            selection = np.zeros((len(elements), len(self.properties)))
+            for element in set(elements):
+                selection[list(elements).index(element), self.element_columns.get(element, [])] = 1.0
+            semedx = selection @ components.T
+
+            tomo.setflags(write=False)
+            semedx.setflags(write=False)
+            self._actions[key] = (tomo, semedx)
+        return self._actions[key]
+
+
+registry = MaterialRegistry()
+
+
 def find_material_by_name(name, materials=materials_data):
     """
     Finds a material by its name from a list of materials.
@@ -123,6 +212,8 @@ def find_material_by_name(name, materials=materials_data):
     Returns:
     - dict: The dictionary of the material if found, otherwise None.
     """
+    if materials is materials_data:
+        return registry.material(name)
     for material in materials:
         if material["Material"] == name:
             return material
@@ -140,6 +231,8 @@ def build_composite_material_actions_XCT_SEM_EDX(composite_name,
     Builds arrays representing the electron density and elemental composition
     for a given composite material, simulating combined XCT and SEM-EDX analysis.
 
+    The arrays come from the memoized MaterialRegistry of the module and are read-only.
+
     Parameters:
     - composite_name (str): The name of the composite material.
     - elements (list): The list of elements to consider for spectral densities.
@@ -149,43 +242,7 @@ def build_composite_material_actions_XCT_SEM_EDX(composite_name,
         - The first array represents the electron density of each component material.
         - The second array represents the elemental composition of each component material.
     """
-    all_ok = False
-    object = None
-    for item in composite_materials:
-        if composite_name == item["Name"]:
-            object = item
-            all_ok = True
-    if not all_ok:
-        print("composite material %s not found"%composite_name)
-    assert all_ok
-
-    # we first build the tomographic densities.
-    class_action_tomo = []
-    for item in object:
-        if type(item) is int:
-            this_material = find_material_by_name(object[item])
-            t = np.array([this_material["Electron Density (electrons/nm3)"]])
-            class_action_tomo.append(t)
-    class_action_tomo = np.column_stack(class_action_tomo)
-
-    # now we need to build the spectral densities
-    element_class_action = []
-    for item in object:
-        element_counter = np.zeros(len(elements))
-        if type(item) is int:
-            this_material = find_material_by_name(object[item])
-            for item in this_material:
-                if item[0:2] in elements:
-                    indx = elements.index(item[0:2])
-                    element_counter[indx] += this_material[item]
-            element_class_action.append(element_counter)
-    element_class_action = np.column_stack(element_class_action)
-    print(element_class_action)
-    return class_action_tomo, element_class_action
-
-
-
-
+    return registry.actions(composite_name, elements)
 
 
 if __name__ == "__main__":
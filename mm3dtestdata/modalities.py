@@ -1,10 +1,19 @@
 import numpy as np
+from scipy.ndimage import gaussian_filter
+from mm3dtestdata import precision
 from mm3dtestdata.materials import build_composite_material_actions_XCT_SEM_EDX
 
 def compute_weighted_map(class_map, class_action):
     """
     Adjusted to handle class_action either as (C,) or (C, M).
+
+    The weights are applied in the floating point type of the precision policy. Probabilities
+    quantized to an unsigned integer type (see precision.quantize) are scaled back on the fly,
+    channel by channel, without a floating point copy of the whole tensor.
     """
+    class_action = np.asarray(class_action, dtype=precision.float_dtype())
+    if class_map.dtype.kind == "u":
+        return _compute_quantized_weighted_map(class_map, class_action)
     # Check if class_action is a simple vector (C,) or a matrix (C, M)
     if class_action.ndim == 1:
         # Reshape to (C, 1) for compatibility with tensordot
@@ -19,6 +28,18 @@ def compute_weighted_map(class_map, class_action):
 
     return weighted_actions
 
+def _compute_quantized_weighted_map(class_map, class_action):
+    squeeze = class_action.ndim == 1
+    class_action = np.atleast_2d(class_action) / np.iinfo(class_map.dtype).max
+    result = np.zeros((class_action.shape[0],) + class_map.shape[1:], dtype=class_action.dtype)
+    for channel, weights in enumerate(class_action):
+        for label, weight in enumerate(weights[:class_map.shape[0]]):
+            if weight != 0:
+                result[channel] += weight * class_map[label]
+    if squeeze:
+        result = result[0]
+    return result
+
 def build_material_maps_XCT_SEM_EDX(class_map, name, elements = ["Si", "Ca", "Fe", "Al"]):
     tomo, semedx = build_composite_material_actions_XCT_SEM_EDX(name, elements)
     tomo_map = compute_weighted_map(class_map, tomo)
@@ -26,9 +47,90 @@ def build_material_maps_XCT_SEM_EDX(class_map, name, elements = ["Si", "Ca", "Fe
     return tomo_map, sem_map, elements
 
 
+def blur_weighted_map(class_map, sigma, class_action, normalizer=None, dtype=None, out=None):
+    """
+    Blur a label map and project it onto weighted channels in one go.
+
+    Gaussian blurring is linear, so projecting the blurred one-hot map of
+    `class_map` with `class_action` equals blurring the M weighted label images
+    class_action[m][class_map]. This never forms the (C, N, N, N) tensor and
+    runs M filter passes instead of C.
+
+    Args:
+    class_map (numpy.ndarray): A 3D array of shape (N, N, N) containing class labels.
+    sigma (float or sequence of float): Standard deviation for Gaussian kernel.
+    class_action (numpy.ndarray): Weights of shape (M, C) or (C,).
+    normalizer (numpy.ndarray, optional): The blurred sum of all class indicators, as used by
+        blur.renormalize; computed when not given.
+    dtype (numpy.dtype, optional): Data type of the result; that of the precision policy by default.
+    out (numpy.ndarray, optional): Array of shape (M, N, N, N) to write the result to; its data type
+        takes precedence over `dtype`.
+
+    Returns:
+    numpy.ndarray: An array of shape (M, N, N, N), or (N, N, N) for a (C,) class_action,
+    equal to compute_weighted_map(blur_it(class_map, sigma), class_action).
+    """
+    dtype = precision.float_dtype(dtype) if out is None else out.dtype
+    class_action = np.asarray(class_action, dtype=dtype)
+    squeeze = class_action.ndim == 1
+    class_action = np.atleast_2d(class_action)
+    if normalizer is None:
+        normalizer = blur_normalizer(class_map, sigma, dtype)
+
+    result = out
+    if result is None:
+        result = np.empty((class_action.shape[0],) + class_map.shape, dtype=dtype)
+    for channel, weights in enumerate(class_action):
+        gaussian_filter(weights[class_map], sigma=sigma, output=result[channel])
+        result[channel] /= normalizer
+
+    if squeeze:
+        result = result[0]
+    return result
 
 
+def blur_normalizer(class_map, sigma, dtype=None):
+    """
+    Compute the per-voxel sum of all blurred class indicators.
+
+    The indicators of a label map sum to one everywhere, so their blurred sum is
+    the blur of a constant image. It is one in the interior and only differs
+    from one where the filter boundary mode does not preserve constants.
 
+    Args:
+    class_map (numpy.ndarray): A 3D array of shape (N, N, N) containing class labels.
+    sigma (float or sequence of float): Standard deviation for Gaussian kernel.
+    dtype (numpy.dtype, optional): Data type of the result; that of the precision policy by default.
 
+    Returns:
+    numpy.ndarray: An array of shape (N, N, N), with zeros replaced by one.
+    """
+    normalizer = gaussian_filter(np.ones(class_map.shape, dtype=precision.float_dtype(dtype)), sigma=sigma)
+    normalizer[normalizer == 0] = 1
+    return normalizer
 
 
+def blur_and_project(class_map, sigma, composite_name, elements=["Si", "Ca", "Fe", "Al"], dtype=None, out=None):
+    """
+    Build blurred XCT and SEM-EDX maps of a class map without forming per-class probabilities.
+
+    Equivalent to build_material_maps_XCT_SEM_EDX(blur_it(class_map, sigma), composite_name, elements).
+
+    Args:
+    class_map (numpy.ndarray): A 3D array of shape (N, N, N) containing class labels.
+    sigma (float or sequence of float): Standard deviation for Gaussian kernel.
+    composite_name (str): The name of the composite material.
+    elements (list): The list of elements to build SEM-EDX channels for.
+    dtype (numpy.dtype, optional): Data type of the maps; that of the precision policy by default.
+    out (tuple, optional): Arrays (XCT map, SEM-EDX maps) to write the maps to.
+
+    Returns:
+    tuple: The XCT map of shape (1, N, N, N), the SEM-EDX maps of shape (M, N, N, N) and the elements.
+    """
+    tomo, semedx = build_composite_material_actions_XCT_SEM_EDX(composite_name, elements)
+    num_classes = int(np.max(class_map)) + 1
+    normalizer = blur_normalizer(class_map, sigma, dtype)
+    tomo_out, sem_out = (None, None) if out is None else out
+    tomo_map = blur_weighted_map(class_map, sigma, tomo[:, :num_classes], normalizer, dtype, out=tomo_out)
+    sem_map = blur_weighted_map(class_map, sigma, semedx[:, :num_classes], normalizer, dtype, out=sem_out)
+    return tomo_map, sem_map, elements
@@ -1,6 +1,82 @@
 import numpy as np
 
-def noise(data, factor, dark_noise):
+from mm3dtestdata import precision
+from mm3dtestdata import seeding
+
+def rayleigh(rng, shape, dtype=np.float32, out=None):
+    """
+    Draw unit-scale Rayleigh samples, i.e. the magnitude of a 2D vector whose
+    components are standard normals, by inverting the Rayleigh CDF.
+
+    Parameters:
+    rng (np.random.Generator): The random number generator.
+    shape (tuple): Shape of the sample; ignored when `out` is given.
+    dtype (np.dtype): Floating point type of the sample (float32 or float64).
+    out (np.array, optional): Array to write the sample to.
+
+    Returns:
+    np.array: The Rayleigh distributed sample.
+    """
+    if out is None:
+        out = rng.random(shape, dtype=dtype)
+    else:
+        rng.random(dtype=out.dtype, out=out)
+    np.subtract(1, out, out=out)
+    np.log(out, out=out)
+    out *= -2
+    np.sqrt(out, out=out)
+    return out
+
+def _noise_block(data, factor, dark_noise, rng, out, chunk_size, add):
+    """
+    Stream noise over `data` in chunks along the first axis, writing to `out`.
+    """
+    result = out
+    data = np.asarray(data)
+    if data.ndim == 0:
+        data = data.reshape(1)
+        out = out.reshape(1)
+    step = max(1, chunk_size // max(1, int(np.prod(data.shape[1:]))))
+    sample = np.empty((min(step, data.shape[0]),) + data.shape[1:], dtype=np.float32)
+    for start in range(0, data.shape[0], step):
+        chunk = data[start:start + step]
+        target = out[start:start + step]
+        buffer = sample[:chunk.shape[0]]
+        delta = rayleigh(rng, None, out=buffer) * chunk
+        delta *= factor
+        dark = rayleigh(rng, None, out=buffer)
+        dark *= dark_noise
+        if add:
+            target[...] = chunk + delta + dark
+        else:
+            target[...] = delta + dark
+    return result
+
+def _legacy_normal(shape, dtype, chunk_size):
+    """
+    Draw standard normals from the global np.random state; the draws match one full size call, but
+    types other than float64 are filled chunk by chunk instead of converting a float64 array.
+    """
+    if np.dtype(dtype) == np.float64:
+        return np.random.normal(0, 1, shape)
+    result = np.empty(shape, dtype=dtype)
+    flat = result.reshape(-1)
+    for start in range(0, flat.size, chunk_size):
+        flat[start:start + chunk_size] = np.random.normal(0, 1, min(chunk_size, flat.size - start))
+    return result
+
+def _legacy_magnitude(shape, dtype, chunk_size):
+    """
+    The magnitude sqrt(a*a + b*b) of two standard normals a and b drawn from the global np.random state.
+    """
+    a = _legacy_normal(shape, dtype, chunk_size)
+    b = _legacy_normal(shape, dtype, chunk_size)
+    a *= a
+    b *= b
+    a += b
+    return np.sqrt(a, out=a)
+
+def noise(data, factor, dark_noise, rng=None, out=None, chunk_size=2 ** 20, add=False):
     """
     Apply noise to the input data. The noise is composed of two components:
     a 'delta' noise that scales with the data and a 'dark' noise that is constant.
@@ -9,20 +85,54 @@ def noise(data, factor, dark_noise):
     drawn from a normal distribution (mean 0, std 1), scaled by the data and a factor.
     The 'dark' noise is similarly generated but scaled by a constant dark noise level.
 
+    Without `rng` the magnitudes are drawn from the global np.random state in the same
+    order as before, which reproduces earlier results for a given np.random.seed; the
+    normals are stored in the float type of the precision policy chunk by chunk.
+    With `rng` the magnitudes are sampled directly as float32 Rayleigh variates from a
+    np.random.Generator, chunk by chunk, so only a chunk sized buffer is allocated;
+    dask arrays are then handled lazily, block by block.
+
     Parameters:
     data (np.array): The input data to which noise is to be applied.
     factor (float): The scaling factor for the 'delta' noise component.
     dark_noise (float): The constant level for the 'dark' noise component.
+    rng (np.random.Generator, SeedSequence or int, optional): Generator or seed for the streaming sampler.
+        For dask arrays every block gets its own stream spawned from it, so the result does not
+        depend on the scheduler or the number of workers.
+    out (np.array, optional): Array to write the result to; may be `data` itself.
+    chunk_size (int, optional): Approximate number of elements processed per chunk.
+    add (bool, optional): If True, return data plus noise instead of the noise alone.
 
     Returns:
-    np.array: The noisy data, which is the sum of the input data with 'delta' and 'dark' noise components.
+    np.array: The noise, whose sum with the input data gives the noisy data (or that sum if `add` is set).
     """
-    a = np.random.normal(0, 1, data.shape)
-    b = np.random.normal(0, 1, data.shape)
-    delta = np.sqrt(a*a + b*b) * data * factor
-    a = np.random.normal(0, 1, data.shape)
-    b = np.random.normal(0, 1, data.shape)
-    dark_noise = np.sqrt(a*a + b*b) * dark_noise
-    return delta+dark_noise
+    if rng is None:
+        dtype = precision.float_dtype()
+        result = _legacy_magnitude(data.shape, dtype, chunk_size) * data
+        result *= factor
+        dark = _legacy_magnitude(data.shape, dtype, chunk_size)
+        dark *= dark_noise
+        result += dark
+        if add:
+            result += data
+        if out is not None:
+            out[...] = result
+            return out
+        return result
+
+    dtype = np.result_type(data.dtype, np.float32)
+
+    if hasattr(data, "map_blocks"):
+        seeds = np.empty(data.numblocks, dtype=object)
+        seeds.ravel()[:] = seeding.seed_sequence(rng).spawn(seeds.size)
+
+        def block_noise(block, block_id=None):
+            block_rng = np.random.default_rng(seeds[block_id])
+            return _noise_block(block, factor, dark_noise, block_rng,
+                                np.empty(block.shape, dtype=dtype), chunk_size, add)
 
+        return data.map_blocks(block_noise, dtype=dtype)
 
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    return _noise_block(data, factor, dark_noise, seeding.generator(rng), out, chunk_size, add)
@@ -0,0 +1,123 @@
+"""A global precision policy for the generation pipeline."""
+import contextlib
+
+import numpy as np
+
+
+class precision_policy(object):
+    """
+    The data types the pipeline computes and stores in when a function is not given one.
+
+    Parameters:
+    - float_dtype (np.dtype): Floating point type of volumes, blurred maps, modality maps, noise
+      and pyramids.
+    - label_dtype (np.dtype or 'auto'): Type of the class and instance maps of balls_and_eggs.fill;
+      'auto' picks the smallest unsigned type that holds the labels.
+    - probability_dtype (np.dtype, optional): If an unsigned integer type, blur_it stores the class
+      probabilities as quantized fractions p * max(dtype), see quantize.
+    """
+    def __init__(self, float_dtype=np.float64, label_dtype=int, probability_dtype=None):
+        self.float_dtype = np.dtype(float_dtype)
+        if not np.issubdtype(self.float_dtype, np.floating):
+            raise ValueError("float_dtype must be a floating point type, got %s" % self.float_dtype)
+        self.label_dtype = label_dtype if label_dtype == 'auto' else np.dtype(label_dtype)
+        self.probability_dtype = None if probability_dtype is None else np.dtype(probability_dtype)
+        if self.probability_dtype is not None and self.probability_dtype.kind != "u":
+            raise ValueError("probability_dtype must be an unsigned integer type, got %s"
+                             % self.probability_dtype)
+
+    def __repr__(self):
+        return "precision_policy(float_dtype=%s, label_dtype=%s, probability_dtype=%s)" % (
+            self.float_dtype, self.label_dtype, self.probability_dtype)
+
+
+_policy = precision_policy()
+
+
+def get_policy():
+    """
+    Return the current precision_policy.
+    """
+    return _policy
+
+
+def set_precision(float_dtype=np.float64, label_dtype=int, probability_dtype=None):
+    """
+    Replace the global precision policy; see precision_policy for the parameters.
+
+    Returns:
+    - precision_policy: The previous policy.
+    """
+    global _policy
+    previous = _policy
+    _policy = precision_policy(float_dtype, label_dtype, probability_dtype)
+    return previous
+
+
+@contextlib.contextmanager
+def precision(float_dtype=np.float64, label_dtype=int, probability_dtype=None):
+    """
+    Run a block under a precision policy, e.g. the whole pipeline in float32:
+
+        with precision(np.float32, label_dtype='auto', probability_dtype=np.uint8):
+            _, _, class_map = obj.fill()
+            probabilities = blur_it(class_map, 1.0)
+
+    The policy is global, so it also holds in threads started inside the block.
+    """
+    global _policy
+    previous = set_precision(float_dtype, label_dtype, probability_dtype)
+    try:
+        yield _policy
+    finally:
+        _policy = previous
+
+
+def float_dtype(dtype=None):
+    """
+    Resolve a floating point type: `dtype` if given, else that of the policy.
+    """
+    return np.dtype(_policy.float_dtype if dtype is None else dtype)
+
+
+def policy_label_dtype(dtype=None):
+    """
+    Resolve a label type: `dtype` if given, else that of the policy (possibly 'auto').
+    """
+    return _policy.label_dtype if dtype is None else dtype
+
+
+def quantize(probabilities, dtype=np.uint8):
+    """
+    Store fractions in [0, 1] as unsigned integers, p -> round(p * max(dtype)).
+
+    Parameters:
+    - probabilities (np.array): The fractions.
+    - dtype (np.dtype): An unsigned integer type; uint8 keeps 1/255 steps, uint16 1/65535.
+
+    Returns:
+    - np.array: The quantized fractions.
+    """
+    scale = np.iinfo(dtype).max
+    result = np.multiply(probabilities, scale, dtype=np.result_type(probabilities, np.float32))
+    np.clip(result, 0, scale, out=result)
+    np.rint(result, out=result)
+    return result.astype(dtype)
+
+
+def dequantize(quantized, dtype=None):
+    """
+    Turn quantized fractions back into floating point numbers; the inverse of quantize.
+
+    Parameters:
+    - quantized (np.array): Unsigned integer fractions; floating point input is returned as is.
+    - dtype (np.dtype, optional): The result type; that of the policy by default.
+
+    Returns:
+    - np.array: The fractions.
+    """
+    quantized = np.asarray(quantized)
+    if quantized.dtype.kind != "u":
+        return quantized
+    dtype = float_dtype(dtype)
+    return np.multiply(quantized, dtype.type(1.0 / np.iinfo(quantized.dtype).max), dtype=dtype)
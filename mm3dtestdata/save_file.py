@@ -1,21 +1,516 @@
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
 import zarr
 import numpy as np
+from scipy import ndimage
 from skimage.transform import pyramid_reduce
-import ome_zarr
-import dask.array as da
-from ome_zarr.writer import write_multiscale
+from ome_zarr.format import CurrentFormat
+from ome_zarr.writer import write_multiscales_metadata
+
+from mm3dtestdata import precision
+
+def level_factors(downscale, max_layer, ndim=3):
+    """
+    Expand a downscale specification into one factor per level and spatial axis.
+
+    Parameters:
+    - downscale (int, tuple or list): A factor for all levels and axes, a tuple with one factor per
+      axis, or a list with one int or tuple per level.
+    - max_layer (int): The number of reduced levels.
+    - ndim (int): The number of reduced (trailing) axes.
+
+    Returns:
+    - list of tuple of int: The factors of every level.
+    """
+    if not isinstance(downscale, list):
+        downscale = [downscale] * max_layer
+    if len(downscale) != max_layer:
+        raise ValueError("expected %d downscale factors, got %d" % (max_layer, len(downscale)))
+    return [tuple(int(f) for f in np.broadcast_to(factor, (ndim,))) for factor in downscale]
+
+def _blocks(image, factor, fill):
+    """
+    View the trailing axes of `image` as blocks of shape `factor`, padding partial blocks with `fill`.
+
+    Returns an array of shape image.shape[:lead] + reduced shape + (prod(factor),).
+    """
+    lead = image.ndim - len(factor)
+    reduced = tuple(-(-n // f) for n, f in zip(image.shape[lead:], factor))
+    pad = [(0, 0)] * lead + [(0, r * f - n) for r, f, n in zip(reduced, factor, image.shape[lead:])]
+    if any(after for _, after in pad):
+        image = np.pad(image, pad, constant_values=fill)
+    split = image.shape[:lead] + tuple(itertools.chain(*zip(reduced, factor)))
+    order = (list(range(lead)) + [lead + 2 * axis for axis in range(len(factor))]
+             + [lead + 2 * axis + 1 for axis in range(len(factor))])
+    return image.reshape(split).transpose(order).reshape(image.shape[:lead] + reduced + (-1,))
+
+def block_mean(image, factor):
+    """
+    Downsample by averaging non-overlapping blocks.
+
+    Parameters:
+    - image (np.array): The image; its trailing len(factor) axes are reduced.
+    - factor (tuple of int): The block shape.
+
+    Returns:
+    - np.array: The block means, of shape ceil(n / f) along the reduced axes and of a floating point
+      type at least float32. Blocks cut off by the border average the voxels they hold.
+    """
+    image = np.asarray(image)
+    dtype = np.result_type(image.dtype, np.float32)
+    lead = image.ndim - len(factor)
+    total = _blocks(image, factor, 0).sum(axis=-1, dtype=np.float64)
+    count = np.ones((), dtype=np.float64)
+    for axis, (n, f) in enumerate(zip(image.shape[lead:], factor)):
+        sizes = np.minimum(f, n - f * np.arange(-(-n // f)))
+        count = np.multiply.outer(count, sizes)
+    return (total / count).astype(dtype)
+
+def _present_labels(labels):
+    if labels.dtype.kind == "u" and labels.dtype.itemsize <= 2:
+        return np.flatnonzero(np.bincount(labels.ravel())).astype(labels.dtype)
+    return np.unique(labels)
+
+def block_mode(labels, factor, max_labels=32):
+    """
+    Downsample a label map by a majority vote over non-overlapping blocks.
+
+    Parameters:
+    - labels (np.array): An integer label map; its trailing len(factor) axes are reduced.
+    - factor (tuple of int): The block shape.
+    - max_labels (int): With at most this many distinct labels (class maps) the votes are counted
+      label by label over strided views; otherwise (instance maps) every block is sorted.
+
+    Returns:
+    - np.array: The most frequent label of every block, of shape ceil(n / f) along the reduced axes.
+      Ties go to the smallest label; blocks cut off by the border only count the voxels they hold.
+    """
+    labels = np.asarray(labels)
+    if not np.issubdtype(labels.dtype, np.integer):
+        raise ValueError("block_mode expects integer labels, got %s" % labels.dtype)
+    lead = labels.ndim - len(factor)
+    reduced = labels.shape[:lead] + tuple(-(-n // f) for n, f in zip(labels.shape[lead:], factor))
+    present = _present_labels(labels)
 
-def create_pyramid(image, max_layer):
-    """ Create a pyramid of images with decreasing resolutions. """
+    if len(present) <= max_labels:
+        views = [labels[(Ellipsis,) + tuple(slice(o, None, f) for o, f in zip(offset, factor))]
+                 for offset in itertools.product(*[range(f) for f in factor])]
+        count_dtype = np.min_scalar_type(int(np.prod(factor)))
+        mode = np.zeros(reduced, dtype=labels.dtype)
+        best = np.zeros(reduced, dtype=count_dtype)
+        count = np.empty(reduced, dtype=count_dtype)
+        for label in present:
+            count[...] = 0
+            for view in views:
+                count[tuple(slice(0, n) for n in view.shape)] += view == label
+            better = count > best
+            mode[better] = label
+            np.maximum(best, count, out=best)
+        return mode
+
+    ragged = any(n % f for n, f in zip(labels.shape[lead:], factor))
+    if ragged:
+        # pad with a value below every label and never let it win the vote
+        sentinel = int(present[0]) - 1
+        votes = np.sort(_blocks(labels.astype(np.int64), factor, sentinel), axis=-1)
+    else:
+        votes = np.sort(_blocks(labels, factor, 0), axis=-1)
+    position = np.arange(votes.shape[-1])
+    starts = np.concatenate([np.ones(votes.shape[:-1] + (1,), dtype=bool),
+                             votes[..., 1:] != votes[..., :-1]], axis=-1)
+    run = position - np.maximum.accumulate(np.where(starts, position, 0), axis=-1) + 1
+    if ragged:
+        run[votes == sentinel] = 0
+    winner = np.argmax(run, axis=-1)[..., None]
+    return np.take_along_axis(votes, winner, axis=-1)[..., 0].astype(labels.dtype)
+
+REDUCERS = {"mean": block_mean, "mode": block_mode}
+
+def create_pyramid(image, max_layer, downscale=4, method="gaussian"):
+    """
+    Create a pyramid of images with decreasing resolutions.
+
+    Parameters:
+    - image (np.array): The full resolution image.
+    - max_layer (int): The number of reduced levels.
+    - downscale (int or list): The reduction factor, see level_factors. The "gaussian" method needs
+      one int per level.
+    - method (str): "gaussian" smooths and resamples all axes with pyramid_reduce. "mean" averages
+      intensity or probability maps and "mode" takes a majority vote of label maps, over blocks of the
+      last three axes.
+
+    Returns:
+    - list of np.array: The levels, starting with `image`.
+    """
+    factors = level_factors(downscale, max_layer, min(3, image.ndim))
     pyramid = [image]
-    for _ in range(max_layer):
-        image = pyramid_reduce(image, downscale=4)
+    for factor in factors:
+        if method == "gaussian":
+            if len(set(factor)) != 1:
+                raise ValueError("the gaussian method needs the same factor along every axis")
+            image = pyramid_reduce(image, downscale=factor[0]).astype(precision.float_dtype(), copy=False)
+        else:
+            image = REDUCERS[method](image, factor)
         pyramid.append(image)
     return pyramid
 
-def save_as_omezarr(image, filename, max_layer=3):
-    """ Save the image as OME-Zarr with image pyramids. """
-    pyramid = create_pyramid(image, max_layer)
-    # Save as OME-Zarr
-    root = zarr.open_group(filename, mode='w')
-    write_multiscale(pyramid, root, axes=["c","z","y","x"])
+def save_as_omezarr(image,
+                    filename,
+                    max_layer=3,
+                    downscale=4,
+                    method="gaussian",
+                    dtype=None,
+                    chunks=64,
+                    shards=None,
+                    codec="zstd",
+                    clevel=5,
+                    shuffle="shuffle",
+                    workers=None,
+                    processes=False):
+    """
+    Save the image as OME-Zarr with image pyramids.
+
+    The levels are computed and written with stream_to_omezarr, Blosc compressed, with chunks
+    encoded and written concurrently by a pool of `workers` threads or processes.
+
+    Parameters:
+    - image (array-like): A numpy, zarr or dask array of shape (z, y, x) or (c, z, y, x).
+    - filename (str): Where to write the OME-Zarr group.
+    - max_layer, downscale, method, dtype: See stream_to_omezarr.
+    - chunks (int or tuple of int): The chunk shape.
+    - shards (int or tuple of int, optional): The shard shape, a multiple of the chunk shape. Chunks
+      are then stored together in one file per shard.
+    - codec (str): The Blosc compressor, e.g. "zstd", "lz4" or "blosclz".
+    - clevel (int): The compression level, 0 to 9.
+    - shuffle (str): "noshuffle", "shuffle" or "bitshuffle".
+    - workers (int, optional): Size of the writer pool; defaults to the number of CPUs.
+    - processes (bool): Use a process pool instead of a thread pool.
+
+    Returns:
+    - zarr.Group: The written group.
+    """
+    compressor = zarr.codecs.BloscCodec(cname=codec, clevel=clevel, shuffle=shuffle)
+    return stream_to_omezarr(image, filename, max_layer=max_layer, downscale=downscale, method=method,
+                             dtype=dtype, chunks=chunks, shards=shards, compressor=compressor,
+                             workers=os.cpu_count() if workers is None else workers,
+                             processes=processes)
+
+def chunk_regions(shape, chunks):
+    """
+    Iterate over the regions of a chunk grid.
+
+    Parameters:
+    - shape (tuple of int): The array shape.
+    - chunks (tuple of int): The chunk shape.
+
+    Yields:
+    - tuple of slice: The region covered by each chunk, in C order.
+    """
+    starts = [range(0, n, c) for n, c in zip(shape, chunks)]
+    for start in itertools.product(*starts):
+        yield tuple(slice(s, min(s + c, n)) for s, c, n in zip(start, chunks, shape))
+
+def _cast(block, dtype):
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(block.dtype, np.integer):
+        info = np.iinfo(dtype)
+        block = np.clip(np.rint(block), info.min, info.max)
+    return block.astype(dtype, copy=False)
+
+def _reduce_region(source, region, factor, method):
+    """
+    Compute one region of the next pyramid level from the previous level.
+
+    For the "gaussian" method the matching part of `source` is read with a halo wide enough for the
+    filter, padded by reflection where it meets the array border, smoothed and linearly interpolated
+    where skimage.transform.resize samples: output voxel i of an axis of length m = ceil(n / f) lies
+    at (i + 1/2) * n / m - 1/2 of the n voxels of the source. This gives the same values as
+    pyramid_reduce of the whole level, also when n is not a multiple of f. The block methods read
+    exactly the blocks of the region.
+    """
+    lead = source.ndim - len(factor)
+    if method != "gaussian":
+        read = region[:lead] + tuple(slice(f * out.start, f * out.stop) for out, f in zip(region[lead:], factor))
+        return REDUCERS[method](np.asarray(source[read]), factor)
+
+    sigma = [2 * f / 6.0 if f > 1 else 0 for f in factor]
+    halo = [int(4.0 * s + 0.5) for s in sigma]
+    read, pad, samples = list(region[:lead]), [(0, 0)] * lead, []
+    for axis, (out, f, h) in enumerate(zip(region[lead:], factor, halo)):
+        n = source.shape[lead + axis]
+        centre = (np.arange(out.start, out.stop) + 0.5) * (n / float(-(-n // f))) - 0.5
+        centre = np.minimum(centre, n - 1)
+        low = np.floor(centre).astype(int)
+        high = np.minimum(low + 1, n - 1)
+        start, stop = low[0] - h, high[-1] + 1 + h
+        read.append(slice(max(start, 0), min(stop, n)))
+        pad.append((max(0, -start), max(0, stop - n)))
+        samples.append((low - start, high - start, centre - low))
+
+    block = np.asarray(source[tuple(read)], dtype=precision.float_dtype())
+    block = np.pad(block, pad, mode="symmetric")
+    block = ndimage.gaussian_filter(block, [0] * lead + sigma, mode="reflect")
+    for axis, (low, high, weight) in enumerate(samples):
+        axis = lead + axis
+        shape = [1] * block.ndim
+        shape[axis] = -1
+        weight = weight.reshape(shape)
+        block = (1 - weight) * np.take(block, low, axis=axis) + weight * np.take(block, high, axis=axis)
+    return block
+
+def _open(array):
+    if isinstance(array, tuple):
+        filename, path = array
+        return zarr.open_group(filename, mode="r+")[path]
+    return array
+
+def _copy_region(target, source, read, region, dtype):
+    """
+    Write a region of level 0; runs in the writer pool.
+    """
+    _open(target)[region] = _cast(np.asarray(source[read]), dtype)
+
+def _reduce_and_write(target, source, region, factor, method, dtype):
+    """
+    Compute and write a region of a reduced level from the level below; runs in the writer pool.
+    """
+    _open(target)[region] = _cast(_reduce_region(_open(source), region, factor, method), dtype)
+
+def _run(pool, function, tasks, limit):
+    """
+    Run function(*args) for every args in tasks, with at most `limit` tasks in flight.
+    """
+    if pool is None:
+        for args in tasks:
+            function(*args)
+        return
+    pending = set()
+    for args in tasks:
+        if len(pending) >= limit:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        pending.add(pool.submit(function, *args))
+    for future in pending:
+        future.result()
+
+def _grid_shape(grid, lead):
+    if grid is None:
+        return None
+    if np.isscalar(grid):
+        grid = (1,) * lead + (int(grid),) * 3
+    return tuple(grid)
+
+def stream_to_omezarr(image,
+                      filename,
+                      max_layer=3,
+                      downscale=4,
+                      method="gaussian",
+                      dtype=None,
+                      chunks=64,
+                      shards=None,
+                      compressor="auto",
+                      axes=None,
+                      workers=1,
+                      processes=False):
+    """
+    Write an image and its pyramid to OME-Zarr one chunk at a time.
+
+    Level 0 is copied chunk by chunk from `image`; every coarser level is computed chunk by chunk
+    from the level already written to disk, reading each region with a halo for the smoothing.
+    Only the spatial (last three) axes are reduced. The "gaussian" method matches
+    skimage.transform.pyramid_reduce (which resamples by n / ceil(n / f) along an axis of length n,
+    so the scale metadata of a level is the ratio of the lengths), the "mean" and "mode" methods
+    match block_mean and block_mode, but nothing larger than a region of the previous level is
+    ever held in memory.
+
+    Parameters:
+    - image (array-like): A numpy, zarr or dask array of shape (z, y, x) or (c, z, y, x).
+    - filename (str or zarr store): Where to write the OME-Zarr group; a path when `processes` is set.
+    - max_layer (int): The number of reduced levels.
+    - downscale (int, tuple or list): The reduction factors between levels, see level_factors.
+    - method (str): "gaussian", "mean" (intensity and probability maps) or "mode" (label maps).
+    - dtype (np.dtype, optional): Data type of all levels; defaults to that of `image`. Reduced
+      levels are rounded when an integer type is chosen.
+    - chunks (int or tuple of int): The chunk shape; an int gives cubic spatial chunks holding
+      one channel each.
+    - shards (int or tuple of int, optional): The shard shape, a multiple of the chunk shape.
+    - compressor: Passed to zarr as `compressors`, e.g. zarr.codecs.BloscCodec(cname="zstd").
+    - axes (list of str, optional): The axis names; "c", "z", "y", "x" by default.
+    - workers (int): The number of regions computed and written concurrently. Every task writes
+      whole chunks (or whole shards), so tasks never touch the same stored object.
+    - processes (bool): Run the tasks in a process pool instead of a thread pool.
+
+    Returns:
+    - zarr.Group: The written group.
+    """
+    dtype = np.dtype(image.dtype if dtype is None else dtype)
+    lead = image.ndim - 3
+    chunks = _grid_shape(chunks, lead)
+    shards = _grid_shape(shards, lead)
+    if shards is not None and any(s % c for s, c in zip(shards, chunks)):
+        raise ValueError("the shard shape %s is not a multiple of the chunk shape %s" % (shards, chunks))
+    if axes is None:
+        axes = ["c", "z", "y", "x"][-image.ndim:]
+    if method not in ("gaussian",) + tuple(REDUCERS):
+        raise ValueError("unknown pyramid method %r" % method)
+    factors = level_factors(downscale, max_layer)
+
+    root = zarr.open_group(filename, mode="w")
+    shapes = [tuple(image.shape)]
+    for factor in factors:
+        shapes.append(shapes[-1][:lead] + tuple(-(-n // f) for n, f in zip(shapes[-1][lead:], factor)))
+
+    pool = None
+    if workers > 1:
+        pool = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(max_workers=workers)
+    source = None
+    try:
+        for level, shape in enumerate(shapes):
+            level_chunks = tuple(min(c, n) for c, n in zip(chunks, shape))
+            level_shards = None
+            if shards is not None:
+                level_shards = tuple(max(c, min(s, n) // c * c) for s, c, n in zip(shards, level_chunks, shape))
+            array = root.create_array(str(level), shape=shape, dtype=dtype, chunks=level_chunks,
+                                      shards=level_shards, compressors=compressor, dimension_names=axes)
+            target = (filename, str(level)) if processes else array
+            regions = chunk_regions(shape, level_shards or level_chunks)
+            if level == 0 and processes:
+                tasks = ((target, np.asarray(image[region]), Ellipsis, region, dtype) for region in regions)
+            elif level == 0:
+                tasks = ((target, image, region, region, dtype) for region in regions)
+            else:
+                tasks = ((target, source, region, factors[level - 1], method, dtype) for region in regions)
+            _run(pool, _copy_region if level == 0 else _reduce_and_write, tasks, 2 * workers)
+            source = target
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # voxel i of level l is centred on voxel S * (i + 1/2) - 1/2 of level 0: S is the product of the
+    # factors for the block methods, and the ratio of the lengths for the resampling of "gaussian"
+    datasets = []
+    for level in range(len(shapes)):
+        if method == "gaussian":
+            total = [n / float(m) for n, m in zip(shapes[0][lead:], shapes[level][lead:])]
+        else:
+            total = np.prod(np.array([(1, 1, 1)] + factors[:level]), axis=0)
+        scale = [1.0] * lead + [float(f) for f in total]
+        translation = [0.0] * lead + [(float(f) - 1) / 2.0 for f in total]
+        datasets.append({"path": str(level),
+                         "coordinateTransformations": [{"type": "scale", "scale": scale},
+                                                       {"type": "translation", "translation": translation}]})
+    write_multiscales_metadata(root, datasets, fmt=CurrentFormat(), axes=axes)
+    return root
+
+class pipeline_writer(object):
+    """
+    Write arrays in background threads while the caller computes the next ones.
+
+    submit() queues an array and returns at once, so the next scene can be generated while earlier
+    ones are encoded and written. The queue is bounded: once `max_pending` arrays wait, submit()
+    blocks until a writer frees a slot, which caps memory at max_pending + writers arrays.
+    Submitted arrays must not be modified until their write is done.
+
+        with save_file.pipeline_writer(max_layer=2, workers=4) as writer:
+            for seed in seeds:
+                ...
+                writer.submit(modality_map, "scene_%d.zarr" % seed)
+
+    Parameters:
+    - writers (int): The number of background writer threads.
+    - max_pending (int): The number of submitted arrays that may wait for a writer.
+    - save (callable, optional): Called as save(image, filename, **kwargs); save_as_omezarr by default.
+    - save_kwargs: Default keyword arguments for `save`.
+    """
+    def __init__(self, writers=1, max_pending=2, save=None, **save_kwargs):
+        self.save = save_as_omezarr if save is None else save
+        self.save_kwargs = save_kwargs
+        self.queue = queue.Queue(max_pending)
+        self.errors = []
+        self.errors_lock = threading.Lock()
+        self.closed = False
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(writers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                future, args, kwargs = job
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(self.save(*args, **kwargs))
+                    except BaseException as error:
+                        with self.errors_lock:
+                            self.errors.append(error)
+                        future.set_exception(error)
+            finally:
+                self.queue.task_done()
+
+    def _raise_errors(self):
+        # writer threads append while this runs, so take the errors out under the lock
+        with self.errors_lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def submit(self, image, filename, **kwargs):
+        """
+        Queue an array for writing; blocks while the queue is full.
+
+        Parameters:
+        - image (array-like): The array to write.
+        - filename (str): Where to write it.
+        - kwargs: Keyword arguments for `save`, overriding the defaults given to the writer.
+
+        Returns:
+        - concurrent.futures.Future: Resolves to the result of `save`.
+
+        Raises the first error of an earlier write, if any.
+        """
+        if self.closed:
+            raise RuntimeError("submit on a closed pipeline_writer")
+        self._raise_errors()
+        future = Future()
+        self.queue.put((future, (image, filename), dict(self.save_kwargs, **kwargs)))
+        return future
+
+    def flush(self):
+        """
+        Wait until every submitted array is written; raises the first error of a write, if any.
+        """
+        self.queue.join()
+        self._raise_errors()
+
+    def close(self):
+        """
+        Flush and stop the writer threads. Further submits raise a RuntimeError.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        else:
+            # do not mask the caller's exception with a write error
+            try:
+                self.close()
+            except BaseException:
+                pass
@@ -0,0 +1,55 @@
+"""Helpers to thread numpy random generators through the package."""
+import numpy as np
+
+
+def seed_sequence(seed=None):
+    """
+    Turn a seed into a numpy.random.SeedSequence.
+
+    Parameters:
+    - seed: None, int, sequence of int, numpy.random.SeedSequence or numpy.random.Generator
+        The source of entropy. A Generator contributes entropy drawn from its
+        stream, so the result is reproducible if the Generator is.
+
+    Returns:
+    - numpy.random.SeedSequence
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(seed.integers(2 ** 32, size=4))
+    return np.random.SeedSequence(seed)
+
+
+def generator(seed=None):
+    """
+    Turn a seed into a numpy.random.Generator.
+
+    Parameters:
+    - seed: None, int, sequence of int, numpy.random.SeedSequence or numpy.random.Generator
+        A Generator is returned as is.
+
+    Returns:
+    - numpy.random.Generator
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed_sequence(seed))
+
+
+def spawn(seed, n):
+    """
+    Spawn independent generators, e.g. one per object, chunk or worker.
+
+    Parameters:
+    - seed: None, int, sequence of int, numpy.random.SeedSequence or numpy.random.Generator
+        The parent seed.
+    - n: int
+        The number of generators.
+
+    Returns:
+    - list of numpy.random.Generator
+        Generator i only depends on the parent seed and on i, so work can be
+        distributed over any number of workers with identical results.
+    """
+    return [np.random.default_rng(child) for child in seed_sequence(seed).spawn(n)]
@@ -10,26 +10,34 @@ with open('README.rst') as readme_file:
 with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = [ ]
+requirements = ['numpy', 'scipy', 'einops']
+
+extras_requirements = {
+    'zarr': ['zarr>=3', 'dask', 'ome-zarr>=0.11', 'scikit-image'],
+}
 
 test_requirements = ['pytest>=3', ]
 
 setup(
     author="Petrus H. Zwart",
     author_email='PHZwart@lbl.gov',
-    python_requires='>=3.6',
+    python_requires='>=3.11',
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
-        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.11',
     ],
+    entry_points={
+        'console_scripts': [
+            'mm3d-ensemble=mm3dtestdata.ensemble:main',
+        ],
+    },
     description="A set of routines to build a 3D dataset for testing multimodal data integration",
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="BSD license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -41,5 +41,127 @@ def test_all():
     assert ref_cs3 == cs3
 
 
+def test_blur_it_per_class():
+    obj = builder.balls_and_eggs(scale=32, border=5, seed=42)
+    _, _, class_map = obj.fill()
+    num_classes = int(np.max(class_map)) + 1
+    dense = blur.one_hot_encode(class_map, num_classes)
+    dense = blur.renormalize(blur.apply_gaussian_blur(dense, 0.5))
+    assert np.array_equal(blur.blur_it(class_map, 0.5), dense)
+
+    single = blur.blur_it(class_map, 0.5, dtype=np.float32)
+    assert single.dtype == np.float32
+    assert np.max(np.abs(single - dense)) < 1e-5
+
+    sparse_map = np.where(class_map == 2, 3, 0).astype(np.uint8)
+    result = blur.blur_it(sparse_map, 1.0, dtype=np.float32)
+    assert result.shape == (4, 32, 32, 32)
+    assert np.all(result[1] == 0)
+    assert np.all(result[2] == 0)
+    assert abs(np.sum(result, dtype=np.float64) - 32 ** 3) < 1e-2
+
+
+def test_chunked_blur(tmp_path):
+    import dask.array as da
+    import zarr
+    from scipy.ndimage import gaussian_filter
+    image = np.random.uniform(0, 1, (37, 30, 21))
+    for sigma in [1.0, (0.5, 2.0, 3.3)]:
+        expected = gaussian_filter(image, sigma)
+        assert np.array_equal(blur.chunked_gaussian_filter(image, sigma, chunks=8, workers=3), expected)
+        lazy = blur.chunked_gaussian_filter(da.from_array(image, chunks=10), sigma)
+        assert np.array_equal(lazy.compute(), expected)
+        out = np.zeros_like(image)
+        assert blur.chunked_gaussian_filter(da.from_array(image, chunks=10), sigma, out=out) is out
+        assert np.array_equal(out, expected)
+
+    source = zarr.create_array(str(tmp_path / "in.zarr"), shape=image.shape, chunks=(8, 8, 8), dtype=float)
+    source[...] = image
+    out = zarr.create_array(str(tmp_path / "out.zarr"), shape=image.shape, chunks=(16, 16, 16), dtype=float)
+    blur.chunked_gaussian_filter(source, 2.0, out=out, workers=2)
+    assert np.array_equal(out[...], gaussian_filter(image, 2.0))
+    # blocks of 6 straddle the 16-voxel chunks of `out`; they are widened so no two threads share one
+    misaligned = zarr.create_array(str(tmp_path / "misaligned.zarr"), shape=image.shape, chunks=(16, 16, 16),
+                                   dtype=float)
+    blur.chunked_gaussian_filter(image, 2.0, chunks=6, out=misaligned, workers=4)
+    assert np.array_equal(misaligned[...], gaussian_filter(image, 2.0))
+
+    obj = builder.balls_and_eggs(scale=32, border=5, seed=42)
+    _, _, class_map = obj.fill()
+    assert np.array_equal(blur.blur_it(class_map, 1.0, chunks=12, workers=2), blur.blur_it(class_map, 1.0))
+    dense = blur.one_hot_encode(class_map, 4)
+    assert np.array_equal(blur.apply_gaussian_blur(dense, 1.0, chunks=12), blur.apply_gaussian_blur(dense, 1.0))
+
+
+def test_blur_scale_space():
+    obj = builder.balls_and_eggs(scale=48, border=8, radius=10, rng=1)
+    _, _, class_map = obj.fill()
+    sigmas = [3.0, 1.0, 2.0, (2.0, 2.5, 3.0)]
+    levels = blur.blur_scale_space(class_map, sigmas)
+    assert np.array_equal(levels[1], blur.blur_it(class_map, 1.0))
+    for sigma, level in zip(sigmas, levels):
+        expected = blur.blur_it(class_map, sigma)
+        assert level.shape == expected.shape
+        assert np.max(np.abs(level - expected)) < 1e-2
+    with pytest.raises(ValueError):
+        blur.blur_scale_space(class_map, [(1.0, 3.0, 1.0), (2.0, 2.0, 2.0)])
+
+
+def test_fft_blur():
+    from scipy.ndimage import gaussian_filter
+    image = np.random.uniform(0, 1, (30, 25, 21))
+    for mode in ["reflect", "mirror", "nearest", "constant", "wrap"]:
+        for sigma in [0.7, (1.0, 2.5, 0.0), 6.0]:
+            expected = gaussian_filter(image, sigma, mode=mode)
+            assert np.allclose(blur.fft_gaussian_filter(image, sigma, mode=mode), expected, atol=1e-12)
+
+    transfer = blur.gaussian_transfer_function((32, 32, 32), 2.0, np.float32)
+    assert transfer is blur.gaussian_transfer_function((32, 32, 32), (2.0, 2.0, 2.0), np.float32)
+    assert transfer.shape == (32, 32, 17) and transfer.dtype == np.float32
+
+    obj = builder.balls_and_eggs(scale=32, border=5, seed=42)
+    _, _, class_map = obj.fill()
+    spatial = blur.blur_it(class_map, 2.0, backend="spatial")
+    assert np.allclose(blur.blur_it(class_map, 2.0, backend="fft"), spatial, atol=1e-12)
+    sparse_map = np.where(class_map == 2, 3, 0)
+    assert np.allclose(blur.blur_it(sparse_map, 2.0, backend="fft"), blur.blur_it(sparse_map, 2.0), atol=1e-12)
+    dense = blur.one_hot_encode(class_map, 4)
+    assert np.allclose(blur.apply_gaussian_blur(dense, 2.0, backend="fft"),
+                       blur.apply_gaussian_blur(dense, 2.0, backend="spatial"), atol=1e-12)
+
+    assert blur.choose_backend((32, 32, 32), 1.0) == "spatial"
+    unlimited = blur.blur_cost_model(memory_limit=2 ** 50)
+    assert blur.choose_backend((1024, 1024, 1024), 32.0, model=unlimited) == "fft"
+    # the padded transforms of one 1024**3 class take far more than the default memory limit
+    assert blur.choose_backend((1024, 1024, 1024), 32.0) == "spatial"
+    fast_fft = blur.blur_cost_model(fft_cost=0.0)
+    assert blur.choose_backend((32, 32, 32), 2.0, model=fast_fft) == "fft"
+    assert np.allclose(blur.blur_it(class_map, 2.0, cost_model=fast_fft), spatial, atol=1e-12)
+
+    spatial_cost, fft_cost = blur.SPATIAL_COST, blur.FFT_COST
+    model = blur.calibrate_backend(sizes=(16,), sigmas=(1.0, 2.0), repeat=1, memory_limit=2 ** 20)
+    assert (blur.SPATIAL_COST, blur.FFT_COST) == (spatial_cost, fft_cost)
+    assert len(model.timings) == 2 and model.memory_limit == 2 ** 20
+
+
+def test_fft_blur_memory():
+    import tracemalloc
+    shape, sigma = (64, 64, 64), 6.0
+    class_map = np.random.default_rng(0).integers(0, 8, shape)
+    expected = blur.blur_it(class_map, sigma, backend="spatial")
+    single = blur.blur_cost_model(memory_limit=blur.blur_cost_model().fft_bytes(shape, (sigma,) * 3))
+    blur.blur_it(class_map, sigma, backend="fft", cost_model=single)  # caches the transfer function
+    peaks = []
+    for model in [single, blur.blur_cost_model(memory_limit=2 ** 40)]:
+        tracemalloc.start()
+        result = blur.blur_it(class_map, sigma, backend="fft", cost_model=model)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert np.allclose(result, expected, atol=1e-12)
+    # one class per transform: the result plus the working memory of a single class
+    assert peaks[0] <= result.nbytes + single.memory_limit
+    assert peaks[1] > 2 * peaks[0]
+
+
 if __name__ == "__main__":
     test_all()
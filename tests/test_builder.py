@@ -163,3 +163,75 @@ def test_build():
     v1, i1, c1 = obj.fill()
     result = utils.array_to_ascii_art(i1[40, ...])
     assert result == expected_result_0
+
+
+def test_incremental_fill():
+    obj = builder.balls_and_eggs(scale=64, seed=42)
+    v0, i0, c0 = obj.fill(incremental=True)
+    obj.perturb(cut={'z': 40, 'dz': 3}, erase=0.1)
+    v1, i1, c1 = obj.fill(incremental=True)
+    v2, i2, c2 = obj.fill()
+    assert np.array_equal(v1, v2)
+    assert np.array_equal(i1, i2)
+    assert np.array_equal(c1, c2)
+    assert not np.array_equal(i0, i1)
+
+    obj.reset()
+    v3, i3, c3 = obj.fill(incremental=True)
+    assert np.array_equal(v3, v0)
+    assert np.array_equal(i3, i0)
+    assert np.array_equal(c3, c0)
+
+
+def test_fill_dtypes():
+    obj = builder.balls_and_eggs(scale=32, border=5, seed=42)
+    v1, i1, c1 = obj.fill()
+    v2, i2, c2 = obj.fill(dtype=np.float32, class_dtype='auto', instance_dtype='auto')
+    assert v2.dtype == np.float32
+    assert c2.dtype == np.uint8
+    assert i2.dtype == builder.label_dtype(max(obj.instance_marker))
+    assert np.array_equal(v1, v2)
+    assert np.array_equal(i1, i2)
+    assert np.array_equal(c1, c2)
+
+    assert builder.label_dtype(255) == np.uint8
+    assert builder.label_dtype(256) == np.uint16
+    assert builder.label_dtype(70000) == np.uint32
+
+    out = (np.ones((32, 32, 32), dtype=np.float32),
+           np.ones((32, 32, 32), dtype=np.uint16),
+           np.ones((32, 32, 32), dtype=np.uint8))
+    v3, i3, c3 = obj.fill(out=out)
+    assert v3 is out[0]
+    assert i3 is out[1]
+    assert c3 is out[2]
+    assert np.array_equal(i1, i3)
+    assert np.array_equal(c1, c3)
+
+    obj.perturb(erase=0.2)
+    v4, i4, c4 = obj.fill(incremental=True, out=out)
+    v5, i5, c5 = obj.fill()
+    assert v4 is out[0]
+    assert np.array_equal(i4, i5)
+    assert np.array_equal(c4, c5)
+
+    obj = builder.balls_and_eggs(scale=48, border=4, radius=3, seed=42)
+    assert max(obj.instance_marker) > 255
+    out = (np.zeros((48, 48, 48)), np.zeros((48, 48, 48), dtype=np.uint8), np.zeros((48, 48, 48), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        obj.fill(out=out)
+    with pytest.raises(ValueError):
+        obj.fill(instance_dtype=np.uint8)
+
+
+def test_pickle():
+    import pickle
+    for kwargs in ({'rng': 1}, {'seed': 1}):
+        obj = builder.balls_and_eggs(scale=32, border=5, **kwargs)
+        copy = pickle.loads(pickle.dumps(obj))
+        assert np.array_equal(copy.fill()[1], obj.fill()[1])
+    np.random.seed(3)
+    copy.perturb(shake=1.0, erase=0.2)
+    np.random.seed(3)
+    obj.perturb(shake=1.0, erase=0.2)
+    assert np.array_equal(copy.fill()[1], obj.fill()[1])
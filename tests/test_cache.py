@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""Tests for `mm3dtestdata` package."""
+
+import pytest
+
+import json
+import os
+import numpy as np
+from mm3dtestdata import blur
+from mm3dtestdata import builder
+from mm3dtestdata import cache
+from mm3dtestdata import modalities
+
+np.random.seed(142)
+
+PARAMS = {"scale": 48, "radius": 10, "border": 8, "rng": 42}
+
+
+@pytest.mark.parametrize("storage", ["npy", "zarr"])
+def test_stages(tmp_path, storage):
+    scenes = cache.scene_cache(str(tmp_path), storage=storage)
+    maps = cache.modality_maps(scenes, PARAMS, 1.0, "VEQI")
+    assert scenes.misses == 3
+
+    _, _, class_map = builder.balls_and_eggs(**PARAMS).fill()
+    tomo, sem, _ = modalities.build_material_maps_XCT_SEM_EDX(blur.blur_it(class_map, 1.0), "VEQI")
+    assert np.array_equal(maps["tomo"][:], tomo)
+    assert np.array_equal(maps["sem"][:], sem)
+
+    again = cache.modality_maps(scenes, PARAMS, 1.0, "VEQI")
+    assert (scenes.hits, scenes.misses) == (1, 3)
+    if storage == "npy":
+        assert isinstance(again["tomo"], np.memmap)
+        assert not again["tomo"].flags.writeable
+
+    # a new downstream parameter reuses the labels and blurred maps
+    cache.modality_maps(scenes, PARAMS, 1.0, "VEQI", elements=["Si", "Fe"])
+    assert (scenes.hits, scenes.misses) == (2, 4)
+    cache.blurred(scenes, PARAMS, 2.0)
+    assert (scenes.hits, scenes.misses) == (3, 5)
+
+
+def test_eviction(tmp_path):
+    scenes = cache.scene_cache(str(tmp_path))
+    first = cache.labels(scenes, PARAMS)
+    size = scenes.nbytes
+    scenes.max_bytes = int(1.5 * size)
+    cache.labels(scenes, dict(PARAMS, rng=43))
+    assert len(scenes.entries()) == 1
+    with open(os.path.join(scenes.entries()[0][2], "meta.json")) as handle:
+        assert json.load(handle)["params"]["builder"]["rng"] == 43
+    assert np.array_equal(first["class_map"], cache.labels(scenes, PARAMS)["class_map"])
+    with pytest.raises(ValueError):
+        cache.labels(scenes, {"scale": 48, "seed": 42})
+
+
+def test_default_arguments(tmp_path):
+    scenes = cache.scene_cache(str(tmp_path))
+    cache.labels(scenes, PARAMS, perturb={"erase": 0.1})
+    defaults = dict(PARAMS, fraction=0.5, seed=None)
+    cache.labels(scenes, defaults, perturb={"erase": 0.1, "shake": None})
+    assert (scenes.hits, scenes.misses) == (1, 1)
+    assert len(scenes.entries()) == 1
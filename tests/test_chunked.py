@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+"""Tests for `mm3dtestdata` package."""
+
+import pytest
+
+import numpy as np
+import dask
+from mm3dtestdata import builder
+from mm3dtestdata import chunked
+
+np.random.seed(142)
+
+
+def test_fill_chunked(tmp_path):
+    obj = builder.balls_and_eggs(scale=48, radius=8, border=5, seed=42)
+    obj.perturb(erase=0.1)
+    v1, i1, c1 = obj.fill()
+
+    v2, i2, c2 = dask.compute(*chunked.fill_chunked(obj, chunks=20))
+    assert np.array_equal(v1, v2)
+    assert np.array_equal(i1, i2)
+    assert np.array_equal(c1, c2)
+
+    v3, i3, c3 = chunked.fill_chunked(obj, chunks=16, store=str(tmp_path / "scene.zarr"))
+    assert v3.chunks == (16, 16, 16)
+    assert np.array_equal(v1, v3[...])
+    assert np.array_equal(i1, i3[...])
+    assert np.array_equal(c1, c3[...])
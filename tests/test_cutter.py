@@ -45,3 +45,100 @@ def test_schaaf(eps=1e-5):
 
     subsample = tmp_fz[slice(0,128,4),slice(0,128,4)]
     assert np.sum(np.abs(subsample - fz)) < 1e-3
+
+
+def test_multichannel_stencil():
+    data = np.random.random((5, 20, 21, 22))
+    sobj = cutter.schaaf(data.shape)
+    for method in ["linear", "nearest"]:
+        for normal, point in [((1, 2, 3), (10.3, 9.0, 11.7)), ((0, 0, 1), (0.0, 0.0, 0.0))]:
+            plane_eq = sobj.plane_equation(normal, point)
+            plane_points, _ = sobj.sample_plane(plane_eq, point, 24, 0.9)
+            f = sobj.plakje(normal, point, 24, 0.9, data, method)
+            assert f.shape == (5, 24, 24)
+            for channel in range(5):
+                expected = sobj.interpolate_block_scipy(plane_points, data[channel], method)
+                expected = expected.reshape(24, 24).T
+                assert np.array_equal(np.isnan(expected), np.isnan(f[channel]))
+                assert np.nanmax(np.abs(expected - f[channel])) < 1e-10
+
+
+def test_plakje_stack():
+    data = np.random.random((3, 20, 21, 22))
+    sobj = cutter.schaaf(data.shape)
+    normal = (1, 2, 3)
+    points = [np.array((10.1, 9.2, 11.3)) + t * np.array(normal) for t in np.linspace(-2, 2, 5)]
+    points.append((3.3, 4.1, 5.2))
+    for workers in [None, 3]:
+        stack = sobj.plakje_stack(normal, points, 24, 0.9, data, workers=workers)
+        assert stack.shape == (6, 3, 24, 24)
+        for k, point in enumerate(points):
+            expected = sobj.plakje(normal, point, 24, 0.9, data)
+            assert np.array_equal(np.isnan(expected), np.isnan(stack[k]))
+            assert np.nanmax(np.abs(expected - stack[k])) < 1e-8
+
+    stack = sobj.plakje_stack((0, 0, 1), [(10, 10, 5), (10, 10, 6)], 20, 1, data[0], method="nearest")
+    assert stack.shape == (2, 20, 20)
+    assert np.array_equal(stack[1], sobj.plakje((0, 0, 1), (10, 10, 6), 20, 1, data[0], method="nearest"))
+
+
+def test_plan_cache():
+    xct = np.random.random((1, 20, 20, 20))
+    sem = np.random.random((4, 20, 20, 20))
+    sobj = cutter.schaaf(xct.shape)
+    plan = sobj.slice_plan((1, 1, 0), (10, 10, 10), 16, 1.0, xct.shape)
+    f_xct = sobj.plakje((1, 1, 0), (10, 10, 10), 16, 1.0, xct)
+    f_sem = sobj.plakje((1, 1, 0), (10, 10, 10), 16, 1.0, sem)
+    assert sobj.plans.misses == 1
+    assert sobj.plans.hits == 2
+    assert f_sem.shape == (4, 16, 16)
+    assert np.allclose(plan.apply(sem[2]).reshape(16, 16).T, f_sem[2], equal_nan=True)
+
+    small = cutter.schaaf(xct.shape, plan_cache_bytes=int(plan.nbytes * 1.5))
+    small.plakje((1, 1, 0), (10, 10, 10), 16, 1.0, xct)
+    small.plakje((0, 1, 0), (10, 10, 10), 16, 1.0, xct)
+    assert len(small.plans.items) == 1
+    assert small.plans.nbytes <= small.plans.max_bytes
+    small.plakje((1, 1, 0), (10, 10, 10), 16, 1.0, xct)
+    assert small.plans.misses == 3
+
+    uncached = cutter.schaaf(xct.shape, plan_cache_bytes=0)
+    assert np.array_equal(uncached.plakje((1, 1, 0), (10, 10, 10), 16, 1.0, xct), f_xct, equal_nan=True)
+    assert len(uncached.plans.items) == 0
+
+
+def test_out_of_core(tmp_path):
+    import zarr
+    import dask.array as da
+
+    data = np.random.random((2, 24, 25, 26))
+    store = zarr.open_array(str(tmp_path / "volume.zarr"), mode="w", shape=data.shape, chunks=(1, 8, 8, 8),
+                            dtype=data.dtype)
+    store[...] = data
+    sobj = cutter.schaaf(data.shape)
+    expected = sobj.plakje((0, 0, 1), (12.0, 12.0, 4.5), 20, 1.0, data)
+
+    f = sobj.plakje((0, 0, 1), (12.0, 12.0, 4.5), 20, 1.0, store)
+    assert np.allclose(f, expected, equal_nan=True)
+    assert sobj.chunks.misses == 9
+    f = sobj.plakje((0, 0, 1), (12.0, 12.0, 4.5), 20, 1.0, store)
+    assert sobj.chunks.hits == 9
+
+    # chunks rewritten in place are read again
+    store[...] = 2 * data
+    f = sobj.plakje((0, 0, 1), (12.0, 12.0, 4.5), 20, 1.0, store)
+    assert np.allclose(f, 2 * expected, equal_nan=True)
+    assert sobj.chunks.misses == 18
+
+    sharded = zarr.create_array(str(tmp_path / "sharded.zarr"), shape=data.shape, chunks=(1, 8, 8, 8),
+                                shards=(2, 16, 16, 16), dtype=data.dtype)
+    sharded[...] = data
+    assert np.allclose(sobj.plakje((0, 0, 1), (12.0, 12.0, 4.5), 20, 1.0, sharded), expected, equal_nan=True)
+    sharded[...] = 3 * data
+    assert np.allclose(sobj.plakje((0, 0, 1), (12.0, 12.0, 4.5), 20, 1.0, sharded), 3 * expected,
+                       equal_nan=True)
+
+    lazy = da.from_array(data, chunks=(1, 10, 7, 8))
+    f = sobj.plakje((1, 2, 3), (12.1, 11.7, 13.2), 20, 0.8, lazy, method="nearest")
+    assert np.allclose(f, sobj.plakje((1, 2, 3), (12.1, 11.7, 13.2), 20, 0.8, data, method="nearest"),
+                       equal_nan=True)
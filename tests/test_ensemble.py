@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Tests for `mm3dtestdata` package."""
+
+import pytest
+
+import json
+import os
+import numpy as np
+from mm3dtestdata import ensemble
+
+np.random.seed(142)
+
+
+def test_parameter_grid():
+    grid = ensemble.parameter_grid({"scale": [24, 32], "radius": 8, "elements": [["Si", "Fe"]]})
+    assert grid == [{"scale": 24, "radius": 8, "elements": ["Si", "Fe"]},
+                    {"scale": 32, "radius": 8, "elements": ["Si", "Fe"]}]
+    with pytest.raises(ValueError):
+        ensemble.generate_scene({"colour": "red"}, 0)
+
+
+def test_run_ensemble(tmp_path):
+    grid = {"scale": 24, "radius": 8, "border": 3, "perturb": [None, {"erase": 0.2}]}
+    paths = ensemble.run_ensemble(grid, [1, 2], str(tmp_path), workers=2)
+    assert len(paths) == 4
+    assert all(os.path.isfile(path) for path in paths)
+
+    with open(str(tmp_path / "scene_00003.json")) as handle:
+        meta = json.load(handle)
+    assert meta["seed"] == 2
+    assert meta["params"]["perturb"] == {"erase": 0.2}
+
+    expected = ensemble.generate_scene(meta["params"], meta["seed"])
+    with np.load(paths[3]) as stored:
+        assert sorted(stored.files) == sorted(expected)
+        for name in expected:
+            assert np.array_equal(stored[name], expected[name])
+    with np.load(paths[0]) as stored:
+        assert "perturbed_class_map" not in stored.files
+        assert stored["sem"].shape == (4, 24, 24, 24)
+
+
+def test_generate_scene_allocate():
+    params = {"scale": 24, "radius": 8, "border": 3, "perturb": {"erase": 0.2}, "elements": ["Si", "Fe"]}
+    allocated = {}
+
+    def allocate(name, shape, dtype):
+        allocated[name] = np.full(shape, -1, dtype=dtype)
+        return allocated[name]
+
+    result = ensemble.generate_scene(params, 3, allocate)
+    expected = ensemble.generate_scene(params, 3)
+    assert sorted(allocated) == sorted(expected)
+    for name in expected:
+        assert result[name] is allocated[name]
+        assert np.array_equal(result[name], expected[name])
+
+
+def test_run_ensemble_in_flight(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    import time
+    lock = threading.Lock()
+    state = {"submitted": 0, "written": 0, "peak": 0}
+
+    def run_scene(params, seed):
+        time.sleep(0.001)
+        return {}
+
+    def write_scene(out_dir, index, params, seed, descriptors):
+        with lock:
+            state["written"] += 1
+        time.sleep(0.005)
+        return index
+
+    class pool(ThreadPoolExecutor):
+        def submit(self, *args):
+            with lock:
+                state["submitted"] += 1
+                state["peak"] = max(state["peak"], state["submitted"] - state["written"])
+            return ThreadPoolExecutor.submit(self, *args)
+
+    monkeypatch.setattr(ensemble, "ProcessPoolExecutor", pool)
+    monkeypatch.setattr(ensemble, "_run_scene", run_scene)
+    monkeypatch.setattr(ensemble, "_write_scene", write_scene)
+    assert ensemble.run_ensemble({"scale": 24}, list(range(20)), str(tmp_path), workers=2) == list(range(20))
+    assert state["peak"] <= 4
+
+
+def test_main(tmp_path):
+    assert ensemble.main(["--grid", '{"scale": 24, "radius": 8, "border": 3}',
+                          "--seeds", "0:2", "--out", str(tmp_path), "--workers", "1"]) == 0
+    assert os.path.isfile(str(tmp_path / "scene_00001.npz"))
+
+
+def test_run_ensemble_failure_releases_shared_memory(tmp_path):
+    def segments():
+        return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")}
+
+    if not os.path.isdir("/dev/shm"):
+        pytest.skip("no /dev/shm")
+    before = segments()
+    grid = {"scale": 24, "radius": 8, "border": 3, "perturb": [None, {"bogus": 1}]}
+    with pytest.raises(TypeError):
+        ensemble.run_ensemble(grid, [1, 2, 3], str(tmp_path), workers=2)
+    assert segments() <= before
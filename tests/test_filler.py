@@ -453,3 +453,44 @@ def test_matrix():
 """
 
     assert result.replace("\n", "") == expected_result.replace("\n", "")
+
+
+def test_matrix_in_place():
+    N = 24
+    rng = np.random.default_rng(5)
+    for center, radius in [((12.0, 12.0, 12.0), 24), ((3.5, 20.0, 11.3), 9.7), ((40.0, 12.0, 12.0), 30.0)]:
+        class_map = rng.integers(0, 4, (N, N, N))
+        instance_map = class_map * 10
+        volume = class_map * 0.25
+        maps = [volume, class_map, instance_map]
+        expected = [m.copy() for m in maps]
+        tmp = [np.zeros_like(m) for m in maps]
+        fillers.fill_sphere(center, radius, *tmp, instance_label=7, class_label=1, density=0.5)
+        sel = (expected[1] < 2) & (tmp[1] > 0)
+        for e, t in zip(expected, tmp):
+            e[sel] = t[sel]
+        fillers.matrix(center, radius, *maps, instance_label=7)
+        for m, e in zip(maps, expected):
+            assert np.array_equal(m, e)
+
+
+def test_bounding_box_clipped():
+    N = 24
+    center = (2.5, 20.0, 11.3)
+    rotation_matrix = fillers.random_rotation_matrix()
+
+    volume = np.zeros((N, N, N))
+    class_map = np.zeros((N, N, N)).astype(int)
+    instance_map = np.zeros((N, N, N)).astype(int)
+    fillers.fill_ellipsoid(center, 9.0, 4.0, volume, class_map, instance_map,
+                           instance_label=1, rotation_matrix=rotation_matrix)
+
+    x, y, z = np.indices(volume.shape).astype(float)
+    coords = np.array([x.ravel() - center[0], y.ravel() - center[1], z.ravel() - center[2]])
+    xr, yr, zr = np.dot(rotation_matrix, coords).reshape(3, N, N, N)
+    expected = (xr / 9.0) ** 2 + (yr / 4.0) ** 2 + (zr / 4.0) ** 2 < 1
+    assert np.array_equal(class_map == 3, expected)
+
+    assert fillers.bounding_box((-20, 5, 5), (3, 3, 3), (N, N, N)) is None
+    box = fillers.bounding_box((0.5, 5, 23), (3, 3, 3), (N, N, N))
+    assert box == (slice(0, 5), slice(2, 9), slice(20, 24))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+"""Tests for `mm3dtestdata` package."""
+
+import subprocess
+import sys
+
+import pytest
+
+import mm3dtestdata
+
+HEAVY_MODULES = ["torch", "scipy", "dask", "zarr", "skimage", "ome_zarr"]
+
+
+def test_import_is_light():
+    script = ("import sys, time\n"
+              "start = time.perf_counter()\n"
+              "import mm3dtestdata\n"
+              "elapsed = time.perf_counter() - start\n"
+              "print(elapsed)\n"
+              "print(' '.join(m for m in %r if m in sys.modules))\n" % HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", script], check=True,
+                            capture_output=True, text=True).stdout.split("\n")
+    assert output[1] == ""
+    assert float(output[0]) < 1.5
+
+
+def test_lazy_attributes():
+    assert "balls_and_eggs" in dir(mm3dtestdata)
+    from mm3dtestdata import balls_and_eggs, schaaf, blur_it
+    from mm3dtestdata.builder import balls_and_eggs as direct
+    assert balls_and_eggs is direct
+    assert schaaf is mm3dtestdata.cutter.schaaf
+    assert blur_it is mm3dtestdata.blur.blur_it
+    assert callable(mm3dtestdata.noise)
+    with pytest.raises(AttributeError):
+        mm3dtestdata.does_not_exist
+
+
+def test_lazy_submodules():
+    script = ("import mm3dtestdata\n"
+              "for name in ['builder', 'blur', 'cutter', 'fillers', 'modalities', 'materials', 'save_file']:\n"
+              "    assert getattr(mm3dtestdata, name).__name__ == 'mm3dtestdata.' + name\n"
+              "assert 'builder' in dir(mm3dtestdata)\n")
+    subprocess.run([sys.executable, "-c", script], check=True)
@@ -26,5 +26,24 @@ def test_materials():
     assert np.sum(np.abs(a-tomo)) < 1e-4
     assert np.sum(np.abs(semedx-b)) < 1e-4
 
+
+def test_registry():
+    from mm3dtestdata import materials
+    registry = materials.registry
+    assert registry.material("Quartz") is materials.materials_data[registry.row["Quartz"]]
+    assert materials.find_material_by_name("Unobtainium") is None
+    assert registry.table[registry.row["Quartz"], registry.column["Si (atoms/nm3)"]] == 44.1
+
+    a, b = build_composite_material_actions_XCT_SEM_EDX("VEQF", ["Si", "Al", " K"])
+    c, d = build_composite_material_actions_XCT_SEM_EDX("VEQF", ["Si", "Al", " K"])
+    assert a is c and b is d
+    assert not b.flags.writeable
+
+    # an element listed twice only fills its first channel
+    _, b = build_composite_material_actions_XCT_SEM_EDX("VEQF", ["Al", "Si", "Al"])
+    assert np.allclose(b[2], 0) and np.allclose(b[0], [0, 0, 0, 9.2])
+    with pytest.raises(KeyError):
+        build_composite_material_actions_XCT_SEM_EDX("NOPE", ["Si"])
+
 if __name__ =="__main__":
     test_materials()
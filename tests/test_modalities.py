@@ -55,6 +55,25 @@ def test_build_mode():
 
 
 
+def test_blur_and_project():
+    obj = builder.balls_and_eggs(scale=32, border=5, seed=42)
+    _, _, class_map = obj.fill()
+    new_class_map = blur.blur_it(class_map, 1.0)
+    tomo_ref, sem_ref, _ = modalities.build_material_maps_XCT_SEM_EDX(new_class_map, "VEQI", ["Si", "Fe"])
+    tomo_map, sem_map, elements = modalities.blur_and_project(class_map, 1.0, "VEQI", ["Si", "Fe"])
+    assert elements == ["Si", "Fe"]
+    assert tomo_map.shape == tomo_ref.shape
+    assert sem_map.shape == sem_ref.shape
+    assert np.max(np.abs(tomo_map - tomo_ref)) < 1e-10
+    assert np.max(np.abs(sem_map - sem_ref)) < 1e-10
+
+    class_actions = np.array([0, 0, 1.0, 4.0])
+    weighted = modalities.blur_weighted_map(class_map, 1.0, class_actions, dtype=np.float32)
+    assert weighted.shape == (32, 32, 32)
+    assert weighted.dtype == np.float32
+    assert np.max(np.abs(weighted - np.tensordot(class_actions, new_class_map, axes=1))) < 1e-5
+
+
 if __name__ == "__main__":
     test_build_mode()
 
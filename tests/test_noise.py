@@ -46,6 +46,28 @@ def test():
     assert abs( np.mean(delta) - np.sqrt(np.pi/2) ) < 0.005
 
 
+def test_streaming():
+    tmp = np.ones(100000)
+    delta = noise(tmp, 1.0, 0.0, rng=42, chunk_size=1000)
+    assert abs( np.mean(delta) - np.sqrt(np.pi/2) ) < 0.01
+    assert np.array_equal(delta, noise(tmp, 1.0, 0.0, rng=np.random.default_rng(42), chunk_size=1000))
+
+    data = np.full((16, 16, 16), 2.0, dtype=np.float32)
+    delta = noise(data, 0.2, 0.05, rng=7)
+    assert delta.dtype == np.float32
+    assert np.all(delta >= 0)
+
+    out = data.copy()
+    result = noise(out, 0.2, 0.05, rng=7, out=out, add=True)
+    assert result is out
+    assert np.max(np.abs(out - (data + delta))) < 1e-5
+
+    import dask.array as da
+    lazy = noise(da.from_array(data, chunks=8), 0.2, 0.05, rng=7)
+    assert lazy.shape == data.shape
+    assert np.array_equal(lazy.compute(), lazy.compute())
+
+
 if __name__ =="__main__":
     test()
 
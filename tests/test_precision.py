@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""Tests for `mm3dtestdata` package."""
+
+import pytest
+
+import numpy as np
+from mm3dtestdata import blur
+from mm3dtestdata import builder
+from mm3dtestdata import modalities
+from mm3dtestdata import noise
+from mm3dtestdata import precision
+from mm3dtestdata import save_file
+
+np.random.seed(142)
+
+
+def test_float32_pipeline():
+    obj = builder.balls_and_eggs(scale=48, border=8, radius=10, rng=42)
+    volume, instance_map, class_map = obj.fill()
+    probabilities = blur.blur_it(class_map, 1.0)
+    tomo, sem, _ = modalities.build_material_maps_XCT_SEM_EDX(probabilities, "VEQI")
+    assert volume.dtype == np.float64 and probabilities.dtype == np.float64
+
+    with precision.precision(np.float32, label_dtype='auto'):
+        volume32, instance_map32, class_map32 = obj.fill()
+        assert volume32.dtype == np.float32
+        assert class_map32.dtype == np.uint8
+        probabilities32 = blur.blur_it(class_map32, 1.0)
+        assert probabilities32.dtype == np.float32
+        tomo32, sem32, _ = modalities.build_material_maps_XCT_SEM_EDX(probabilities32, "VEQI")
+        assert tomo32.dtype == np.float32 and sem32.dtype == np.float32
+        assert noise(tomo32, 0.1, 0.1).dtype == np.float32
+        assert blur.one_hot_encode(class_map32, 4).dtype == np.float32
+        assert save_file.create_pyramid(probabilities32[0], 1)[1].dtype == np.float32
+    assert precision.get_policy().float_dtype == np.float64
+
+    assert np.array_equal(volume32, volume) and np.array_equal(class_map32, class_map)
+    assert np.allclose(probabilities32, probabilities, atol=1e-5)
+    assert np.allclose(sem32, sem, rtol=1e-4, atol=1e-3)
+
+
+def test_float32_legacy_noise():
+    data = np.random.uniform(0, 1, (20, 21, 22)).astype(np.float32)
+    np.random.seed(7)
+    a, b, c, d = [np.random.normal(0, 1, data.shape).astype(np.float32) for _ in range(4)]
+    expected = np.sqrt(a * a + b * b) * data * 0.2 + np.sqrt(c * c + d * d) * 0.05
+    np.random.seed(7)
+    with precision.precision(np.float32):
+        result = noise(data, 0.2, 0.05, chunk_size=1000)
+    assert result.dtype == np.float32
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_quantized_probabilities(dtype):
+    obj = builder.balls_and_eggs(scale=48, border=8, radius=10, rng=42)
+    _, _, class_map = obj.fill()
+    probabilities = blur.blur_it(class_map, 1.0)
+    with precision.precision(np.float32, probability_dtype=dtype):
+        quantized = blur.blur_it(class_map, 1.0)
+        assert quantized.dtype == dtype
+        step = 1.0 / np.iinfo(dtype).max
+        assert np.abs(precision.dequantize(quantized) - probabilities).max() <= step / 2 + 1e-6
+        tomo, sem, _ = modalities.build_material_maps_XCT_SEM_EDX(quantized, "VEQI")
+        assert sem.dtype == np.float32
+    reference, reference_sem, _ = modalities.build_material_maps_XCT_SEM_EDX(probabilities, "VEQI")
+    assert np.abs(tomo - reference).max() <= 2 * step
+    assert np.abs(sem - reference_sem).max() <= 100 * step
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""Tests for `mm3dtestdata` package."""
+
+import pytest
+
+import numpy as np
+from mm3dtestdata import fillers
+from mm3dtestdata import builder
+from mm3dtestdata import rasterizer
+
+np.random.seed(142)
+
+
+def test_fill_objects_matches_fillers():
+    obj = builder.balls_and_eggs(scale=48, radius=8, border=2, seed=42)
+    obj.perturb(shake=2.0, erase=0.1)
+    table = obj.object_table()
+
+    N = 48
+    volume = np.zeros((N, N, N))
+    class_map = np.zeros((N, N, N)).astype(int)
+    instance_map = np.zeros((N, N, N)).astype(int)
+    for m in range(len(table["kind"])):
+        if table["kind"][m] == rasterizer.SPHERE:
+            fillers.fill_sphere(table["center"][m], table["major_axis"][m],
+                                volume, class_map, instance_map,
+                                instance_label=table["instance_label"][m],
+                                class_label=table["class_label"][m],
+                                density=table["density"][m])
+        else:
+            fillers.fill_ellipsoid(table["center"][m], table["major_axis"][m], table["minor_axis"][m],
+                                   volume, class_map, instance_map,
+                                   instance_label=table["instance_label"][m],
+                                   rotation_matrix=table["rotation_matrix"][m],
+                                   class_label=table["class_label"][m],
+                                   density=table["density"][m])
+
+    for tile_size in [7, 16, 64]:
+        tmp_volume = np.zeros((N, N, N))
+        tmp_class_map = np.zeros((N, N, N)).astype(int)
+        tmp_instance_map = np.zeros((N, N, N)).astype(int)
+        rasterizer.fill_objects(table, tmp_volume, tmp_class_map, tmp_instance_map, tile_size=tile_size)
+        assert np.array_equal(tmp_volume, volume)
+        assert np.array_equal(tmp_class_map, class_map)
+        assert np.array_equal(tmp_instance_map, instance_map)
+
+
+def test_overwrite_order():
+    N = 16
+    table = rasterizer.build_object_table(center=[[8, 8, 8], [8, 8, 10]],
+                                          kind=[rasterizer.SPHERE, rasterizer.SPHERE],
+                                          major_axis=[4, 4],
+                                          minor_axis=[4, 4],
+                                          rotation_matrix=np.zeros((2, 3, 3)),
+                                          class_label=[2, 3],
+                                          instance_label=[5, 6],
+                                          density=[1.0, 0.5])
+    volume = np.zeros((N, N, N))
+    class_map = np.zeros((N, N, N)).astype(int)
+    instance_map = np.zeros((N, N, N)).astype(int)
+    rasterizer.fill_objects(table, volume, class_map, instance_map, tile_size=5)
+    assert instance_map[8, 8, 9] == 6
+    assert instance_map[8, 8, 5] == 5
+    assert volume[8, 8, 9] == 0.5
@@ -8,6 +8,9 @@ import hashlib
 import numpy as np
 import random
 import os
+import threading
+import time
+import zarr
 
 from mm3dtestdata import builder
 from mm3dtestdata import blur
@@ -21,7 +24,7 @@ import utils
 
 np.random.seed(142)
 
-def test():
+def test(tmp_path):
     obj = builder.balls_and_eggs(scale=256, border=55, radius=50, seed=42)
     _, _, class_map = obj.fill()
     new_class_map = blur.blur_it(class_map, 1.0)
@@ -29,17 +32,142 @@ def test():
     class_actions = np.array([[0,0],[0,1],[1.0,0.1],[4.0,0.5]]).T
     modality_map = modalities.compute_weighted_map(new_class_map,class_actions)
 
-    save_file.save_as_omezarr(modality_map,"test.zarr",max_layer=3)
-
-
-
-
-
-
-
-
+    save_file.save_as_omezarr(modality_map,os.path.join(str(tmp_path), "test.zarr"),max_layer=3)
+
+
+def test_stream_to_omezarr(tmp_path):
+    from skimage.transform import pyramid_reduce
+    image = np.random.uniform(0, 1, (2, 64, 64, 32))
+    root = save_file.stream_to_omezarr(image, str(tmp_path / "stream.zarr"), max_layer=2,
+                                       dtype=np.float64, chunks=8)
+    assert np.array_equal(root["0"][:], image)
+    expected = image[1]
+    for level in range(1, 3):
+        expected = pyramid_reduce(expected, downscale=4)
+        assert np.allclose(root[str(level)][1], expected)
+    datasets = root.attrs["ome"]["multiscales"][0]["datasets"]
+    assert datasets[2]["coordinateTransformations"][0]["scale"] == [1.0, 16.0, 16.0, 16.0]
+
+    # axis lengths that are not multiples of the factor are resampled as by pyramid_reduce
+    for shape in [(50, 50, 50), (37, 30, 21)]:
+        image = np.random.uniform(0, 1, shape)
+        root = save_file.stream_to_omezarr(image, str(tmp_path / "ragged.zarr"), max_layer=2,
+                                           dtype=np.float64, chunks=8)
+        expected = image
+        for level in range(1, 3):
+            expected = pyramid_reduce(expected, downscale=4)
+            assert np.allclose(root[str(level)][:], expected)
+        transform = root.attrs["ome"]["multiscales"][0]["datasets"][1]["coordinateTransformations"]
+        assert transform[0]["scale"] == [n / -(-n // 4) for n in shape]
+
+    image = np.random.uniform(0, 1, (2, 64, 64, 32))
+    root = save_file.stream_to_omezarr(image[0], str(tmp_path / "uint8.zarr"), max_layer=1,
+                                       dtype=np.uint8, chunks=16)
+    assert root["1"].dtype == np.uint8
+    assert root["1"].shape == (16, 16, 8)
+
+
+def test_block_reductions():
+    image = np.random.uniform(0, 1, (13, 10, 9))
+    mean = save_file.block_mean(image, (4, 3, 2))
+    assert mean.shape == (4, 4, 5)
+    assert np.isclose(mean[0, 0, 0], image[:4, :3, :2].mean())
+    assert np.isclose(mean[-1, -1, -1], image[12:, 9:, 8:].mean())
+
+    for n_labels in [4, 100]:
+        labels = np.random.randint(0, n_labels, (2, 13, 10, 9))
+        mode = save_file.block_mode(labels, (3, 2, 4))
+        assert mode.shape == (2, 5, 5, 3)
+        for index in np.ndindex(mode.shape):
+            c, i, j, k = index
+            block = labels[c, 3 * i:3 * i + 3, 2 * j:2 * j + 2, 4 * k:4 * k + 4]
+            assert mode[index] == np.argmax(np.bincount(block.ravel()))
+
+
+def test_stream_block_pyramids(tmp_path):
+    obj = builder.balls_and_eggs(scale=48, border=8, radius=8, seed=42)
+    _, instance_map, class_map = obj.fill(class_dtype=np.uint8)
+    downscale = [2, (1, 2, 2)]
+    root = save_file.stream_to_omezarr(class_map, str(tmp_path / "labels.zarr"), max_layer=2,
+                                       downscale=downscale, method="mode", chunks=8)
+    pyramid = save_file.create_pyramid(class_map, 2, downscale=downscale, method="mode")
+    for level in range(3):
+        assert np.array_equal(root[str(level)][:], pyramid[level])
+    assert root["2"].shape == (24, 12, 12)
+
+    probabilities = blur.blur_it(class_map, 1.0)
+    root = save_file.stream_to_omezarr(probabilities, str(tmp_path / "mean.zarr"), max_layer=2,
+                                       downscale=downscale, method="mean", chunks=8)
+    pyramid = save_file.create_pyramid(probabilities, 2, downscale=downscale, method="mean")
+    for level in range(3):
+        assert np.allclose(root[str(level)][:], pyramid[level])
+
+
+def test_parallel_writes(tmp_path):
+    image = np.random.uniform(0, 1, (2, 40, 40, 40)).astype(np.float32)
+    reference = save_file.stream_to_omezarr(image, str(tmp_path / "reference.zarr"), max_layer=2,
+                                            downscale=2, chunks=8)
+    threads = save_file.save_as_omezarr(image, str(tmp_path / "threads.zarr"), max_layer=2,
+                                        downscale=2, chunks=8, workers=3, codec="lz4", clevel=1)
+    processes = save_file.save_as_omezarr(image, str(tmp_path / "processes.zarr"), max_layer=2,
+                                          downscale=2, chunks=8, shards=16, workers=2, processes=True)
+    assert processes["0"].shards == (1, 16, 16, 16)
+    for level in range(3):
+        assert np.array_equal(threads[str(level)][:], reference[str(level)][:])
+        assert np.array_equal(processes[str(level)][:], reference[str(level)][:])
+    with pytest.raises(ValueError):
+        save_file.save_as_omezarr(image, str(tmp_path / "bad.zarr"), chunks=8, shards=12)
+
+
+def test_pipeline_writer(tmp_path):
+    active = []
+    peak = [0]
+    lock = threading.Lock()
+    written = {}
+
+    def save(image, filename, scale=1):
+        with lock:
+            active.append(filename)
+            peak[0] = max(peak[0], len(active))
+        time.sleep(0.01)
+        written[filename] = image * scale
+        with lock:
+            active.remove(filename)
+        return filename
+
+    with save_file.pipeline_writer(writers=2, max_pending=1, save=save, scale=2) as writer:
+        futures = [writer.submit(np.full(3, i), "scene_%d" % i) for i in range(6)]
+        writer.flush()
+        assert len(written) == 6
+        assert futures[3].result() == "scene_3"
+    assert peak[0] <= 2
+    assert np.array_equal(written["scene_5"], np.full(3, 10))
+    with pytest.raises(RuntimeError):
+        writer.submit(np.zeros(3), "late")
+
+    image = np.random.uniform(0, 1, (16, 16, 16))
+    writer = save_file.pipeline_writer(max_layer=1, chunks=8, workers=1)
+    writer.submit(image, str(tmp_path / "scene.zarr"))
+    writer.submit(image, str(tmp_path / "bad.zarr"), chunks=8, shards=12)
+    with pytest.raises(ValueError):
+        writer.close()
+    assert np.array_equal(zarr.open_group(str(tmp_path / "scene.zarr"), mode="r")["0"][:], image)
+
+    submitted = threading.Event()
+
+    def fail(image, filename):
+        submitted.wait()
+        raise OSError(filename)
+
+    writer = save_file.pipeline_writer(writers=4, max_pending=16, save=fail)
+    futures = [writer.submit(None, "scene_%d" % i) for i in range(16)]
+    submitted.set()
+    with pytest.raises(OSError):
+        writer.flush()
+    assert all(isinstance(future.exception(), OSError) for future in futures)
+    writer.flush()
+    writer.close()
 
 
 if __name__ == "__main__":
-    test()
-
+    test(".")
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""Tests for `mm3dtestdata` package."""
+
+import pytest
+
+import numpy as np
+import dask
+import dask.array as da
+from mm3dtestdata import builder
+from mm3dtestdata import fillers
+from mm3dtestdata import noise
+from mm3dtestdata import seeding
+
+np.random.seed(142)
+
+
+def test_spawn():
+    a = [g.random() for g in seeding.spawn(7, 3)]
+    b = [g.random() for g in seeding.spawn(np.random.SeedSequence(7), 3)]
+    assert a == b
+    assert len(set(a)) == 3
+    g = np.random.default_rng(1)
+    assert seeding.generator(g) is g
+    assert np.array_equal(seeding.spawn(np.random.default_rng(5), 2)[1].random(4),
+                          seeding.spawn(np.random.default_rng(5), 2)[1].random(4))
+
+
+def test_builder_rng():
+    np.random.seed(1)
+    obj1 = builder.balls_and_eggs(scale=32, border=5, rng=11)
+    obj1.perturb(shake=1.0, erase=0.2)
+    np.random.seed(2)
+    obj2 = builder.balls_and_eggs(scale=32, border=5, rng=11)
+    obj2.perturb(shake=1.0, erase=0.2)
+    assert obj1.item_type == obj2.item_type
+    assert np.array_equal(obj1.delta, obj2.delta)
+    assert np.array_equal(obj1.eraser, obj2.eraser)
+    for v1, v2 in zip(obj1.fill(), obj2.fill()):
+        assert np.array_equal(v1, v2)
+
+    r1 = fillers.random_rotation_matrix(rng=np.random.default_rng(3))
+    r2 = fillers.random_rotation_matrix(rng=np.random.default_rng(3))
+    assert np.array_equal(r1, r2)
+    assert np.allclose(np.dot(r1, r1.T), np.eye(3))
+
+
+def test_noise_worker_independent():
+    data = da.ones((16, 16, 16), chunks=4)
+    a = noise(data, 0.2, 0.05, rng=3).compute(scheduler="synchronous")
+    b = noise(data, 0.2, 0.05, rng=3).compute(scheduler="threads", num_workers=4)
+    assert np.array_equal(a, b)